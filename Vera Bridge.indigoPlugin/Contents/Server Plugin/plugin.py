@@ -2,18 +2,50 @@
 # -*- coding: utf-8 -*-
 ####################
 
+import os
+import threading
 import traceback
 from operator import itemgetter
 import re
+import time
 import Queue
 import veralib
+import verasim
 import indigo
 
 ################################################################################
 # Globals
 ################################################################################
 kPort = u"3480"
-kFailCountTrigger = 60 * 15
+kCommandPacing = u"100"  # milliseconds
+# the "controller" plugin prop of devices on the Vera in the main host/port prefs - devices created before there could
+# be more than one Vera don't have the prop at all and belong to it too
+kPrimaryController = u""
+kUpdateWaitTimeout = 1  # how long to block waiting for an update before checking whether the thread should stop
+# how long _startControllers waits for a replaced vera thread to finish before trying again on its next pass
+kThreadStopWait = 1
+# how long an optimistic state waits for the vera thread to confirm its command before it's rolled back anyway - the
+# vera thread gives up on a command after kCommandConfirmTimeout, and this covers the command waiting to be sent too
+kPendingStateTimeout = veralib.kCommandConfirmTimeout + 30
+kFlightRecorderFile = u"plugin.recent.log"
+kMetricsPublishInterval = 60  # seconds between updates of the metrics variables
+kMetricsVariableFolder = u"Vera Bridge"
+# the metrics published as Indigo variables when that's turned on, enough to trigger on a Vera that's slow, down or
+# backed up - "Show Metrics" logs everything
+kPublishedPluginMetrics = ("updateQueueDepth", "updatesProcessed", "processUpdateTimeP95")
+kPublishedVeraMetrics = (
+    "connectionState",
+    "commandQueueDepth",
+    "commandsAwaitingConfirmation",
+    "pollFailures",
+    "commandFailures",
+    "commandUnconfirmed",
+    "pollTimeP95",
+    "fullUpdateTimeP95",
+    "commandLatencyP95",
+    "commandConfirmTimeP95",
+    "devicesPerUpdateP95",
+)
 kThermostatModeLookup = {
     "Off": indigo.kHvacMode.Off,
     "CoolOn": indigo.kHvacMode.Cool,
@@ -26,6 +58,16 @@ kThermostatFanLookup = {
     "ContinuousOn": indigo.kFanMode.AlwaysOn,
     "PeriodicOn": indigo.kFanMode.Auto,       # supports a periodic cycle but we don't
 }
+# the Indigo state a command changes optimistically, keyed by the lu_sdata field the vera thread confirms it with
+kOptimisticStateKeys = {
+    "status": "onOffState",
+    "locked": "onOffState",
+    "level": "brightnessLevel",
+    "heatsp": "setpointHeat",
+    "coolsp": "setpointCool",
+    "mode": "hvacOperationMode",
+    "fanmode": "hvacFanMode",
+}
 
 
 ################################################################################
@@ -38,40 +80,146 @@ def isValidHostname(hostname):
     return all(allowed.match(x) for x in hostname.split("."))
 
 
+################################################################################
+def parseControllerList(controllerList):
+    # Turns the comma separated "host" or "host:port" list of additional Veras from the prefs into (host, port)
+    # tuples. Throws a ValueError for any entry that isn't valid.
+    controllers = []
+    for entry in controllerList.split(","):
+        entry = entry.strip()
+        if entry == "":
+            continue
+        host, separator, port = entry.partition(":")
+        portNumber = int(port) if separator else int(kPort)
+        if not isValidHostname(host) or portNumber > 65535 or portNumber < 1:
+            raise ValueError("invalid Vera address: %s" % entry)
+        controllers.append((host, portNumber))
+    return controllers
+
+
 ################################################################################
 class Plugin(indigo.PluginBase):
     ########################################
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        # created first since debugLog and errorLog record into it
+        self.flightRecorder = veralib.VeraFlightRecorder("plugin")
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
         self.debug = pluginPrefs.get("showDebugInfo", False)
-        self.host = pluginPrefs.get("host", None)
-        self.port = int(pluginPrefs.get("port", kPort))
-        self.vera = None
-        self.restartVera = False
+        # (host, port) of each Vera keyed by controller id, and the running vera threads, which all feed updateQueue
+        self.controllers = self._controllersFromPrefs(pluginPrefs)
+        self.veras = {}
+        # vera threads that were stopped for new settings and may still be saving their snapshot
+        self.stoppedVeras = []
+        self.updateQueue = Queue.Queue()
+        # the prefs the vera threads are created with, which change before pluginPrefs does when the config dialog is
+        # saved
+        self.controllerPrefs = pluginPrefs
+        self.controllerLock = threading.Lock()
+        # Indigo device ids keyed by (controller id, Vera device address)
         self.deviceDict = {}
-        if self.host == "localhost" or self.host == "127.0.0.1":
-            self.demoMode = True
-        else:
-            self.demoMode = False
+        # states changed ahead of a command being confirmed, keyed by device id and then state - each has the value it
+        # goes back to if the command isn't confirmed and when to stop waiting for that
+        self.pendingStates = {}
+        # (controller id, address) of devices whose pending states were dropped when their vera thread was replaced,
+        # which the new thread resends once it's created
+        self.staleDevices = set()
+        # (controller id, address) of devices that started while there was no thread for their Vera - at launch
+        # deviceStartComm is called before _startControllers has created any - which get their states once it's there
+        self.devicesAwaitingVera = set()
+        # the last value/uiValue written to the server for each state of each device, keyed by Indigo device id
+        self.stateCache = {}
+        # the plugin's side of the metrics, each vera thread keeps its own
+        self.metrics = veralib.VeraMetrics()
+        self.metrics.addGauge("updateQueueDepth", self.updateQueue.qsize)
+        self.lastMetricsPublished = 0
+        # the last value published to each metrics variable, keyed by variable name
+        self.publishedMetrics = {}
+
+    ########################################
+    def debugLog(self, message, *args):
+        # message is a format string for args, so it's only formatted when debugging is on
+        self.flightRecorder.record(message, args)
+        if self.debug:
+            super(Plugin, self).debugLog(veralib.formatMessage(message, args))
+
+    ########################################
+    def errorLog(self, message):
+        self.flightRecorder.record(message, (), True)
+        super(Plugin, self).errorLog(message)
+        self._saveFlightRecorderAfterError()
+
+    ########################################
+    def _saveFlightRecorderAfterError(self):
+        try:
+            self.flightRecorder.saveAfterError(self._dataPath(kFlightRecorderFile))
+        except Exception:
+            pass
+
+    ########################################
+    def _controllersFromPrefs(self, prefs):
+        controllers = {}
+        host = prefs.get("host", None)
+        if prefs.get("simulate", False):
+            # the main Vera is replaced by a simulated one, any additional Veras are still real
+            controllers[kPrimaryController] = (verasim.kSimulatorHost, verasim.kSimulatorPort)
+        elif host:
+            controllers[kPrimaryController] = (host, int(prefs.get("port", kPort)))
+        try:
+            for additionalHost, additionalPort in parseControllerList(prefs.get("additionalControllers", "")):
+                controllers[u"%s:%i" % (additionalHost, additionalPort)] = (additionalHost, additionalPort)
+        except ValueError, e:
+            self.errorLog("Ignoring additional Veras: %s" % str(e))
+        return controllers
+
+    ########################################
+    def _controllerSettings(self, controllerId, prefs):
+        # what a vera thread is created with (see _createVera) besides its host and port, apart from threadDebug which
+        # a running thread picks up as it is
+        settings = (bool(prefs.get("longPoll", True)), int(prefs.get("commandPacing", kCommandPacing)), bool(prefs.get("recordTraffic", False)))
+        if controllerId == kPrimaryController and prefs.get("simulate", False):
+            settings += (int(prefs.get("simulatedDevices", verasim.kDefaultDeviceCount)), float(prefs.get("simulatedChangeRate", verasim.kDefaultChangeRate)))
+        return settings
+
+    ########################################
+    def _controllerForDevice(self, dev):
+        return dev.pluginProps.get("controller", kPrimaryController)
+
+    ########################################
+    def _veraForDevice(self, dev):
+        return self.veras.get(self._controllerForDevice(dev), None)
+
+    ########################################
+    def _getControllerList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        returnTup = []
+        for controllerId, (host, port) in self.controllers.items():
+            if controllerId == kPrimaryController:
+                returnTup.append((controllerId, u"%s:%i (main)" % (host, port)))
+            else:
+                returnTup.append((controllerId, u"%s:%i" % (host, port)))
+        return sorted(returnTup)
 
     ########################################
     def _getNodeList(self, filter="", valuesDict=None, typeId="", targetId=0):
         self.debugLog("_getNodeList called")
         returnTup = []
-        if self.vera:
+        controllerId = valuesDict.get("controller", kPrimaryController) if valuesDict else kPrimaryController
+        vera = self.veras.get(controllerId, None)
+        if vera:
+            # the vera thread swaps in a new inventory as things change so hang on to one for the whole list
+            inventory = vera.inventory
             if filter == "devices":
                 curDeviceNum = 0
                 if targetId:
                     if targetId in indigo.devices:
                         addStr = indigo.devices[targetId].address
-                        if addStr:
+                        if addStr and self._controllerForDevice(indigo.devices[targetId]) == controllerId:
                             curDeviceNum = int(addStr)
                 veraDeviceNumList = []
                 # if the device is being edited the device should show up in the list selected
                 for device in indigo.devices.iter("com.perceptiveautomation.indigoplugin.vera"):
-                    if device.configured and int(device.address) != curDeviceNum:
+                    if device.configured and self._controllerForDevice(device) == controllerId and int(device.address) != curDeviceNum:
                         veraDeviceNumList.append(int(device.address))
-                for id, deviceDict in self.vera.devices.items():
+                for id, deviceDict in inventory.devices.items():
                     veraDeviceId = valuesDict.get("veraDeviceId", 0)
                     if veraDeviceId == "":
                         veraDeviceId = 0
@@ -79,7 +227,7 @@ class Plugin(indigo.PluginBase):
                         returnTup.append((id, deviceDict["name"]))
             else:
                 # looking for scenes - this one's easy
-                returnTup = [(key, item.get("name", "Unknown")) for key, item in self.vera.scenes.items()]
+                returnTup = [(key, item.get("name", "Unknown")) for key, item in inventory.scenes.items()]
         return sorted(returnTup, key=itemgetter(1))
 
     ########################################
@@ -90,7 +238,7 @@ class Plugin(indigo.PluginBase):
 
     ########################################
     def getDeviceFactoryUiValues(self, devIdList):
-        self.debugLog("getDeviceFactoryUiValues: %s" % str(devIdList))
+        self.debugLog("getDeviceFactoryUiValues: %s", devIdList)
         isInitialDefine = (len(devIdList) == 0)
         valuesDict = indigo.Dict()
         if not isInitialDefine and devIdList[0] in indigo.devices:
@@ -98,6 +246,7 @@ class Plugin(indigo.PluginBase):
             nodeId = dev.address
             if nodeId != "":
                 valuesDict['veraDeviceId'] = nodeId
+            valuesDict['controller'] = self._controllerForDevice(dev)
         errorsDict = indigo.Dict()
         return (valuesDict, errorsDict)
 
@@ -116,11 +265,19 @@ class Plugin(indigo.PluginBase):
         self.debugLog("closedDeviceFactoryUi")
         if not userCancelled:
             deviceTypeMap = None
+            controllerId = valuesDict.get("controller", kPrimaryController)
+            vera = self.veras.get(controllerId, None)
+            if not vera:
+                self.errorLog("The selected Vera isn't connected, the device wasn't changed.")
+                return
+            deviceDict = vera.inventory.devices.get(int(valuesDict["veraDeviceId"]), None)
+            if deviceDict is None:
+                self.errorLog("The selected device is no longer on the Vera, the device wasn't changed.")
+                return
             if len(devIdList) > 0:
-                self.debugLog("closedDeviceFactoryUi: devIdList: %s" % str(devIdList))
+                self.debugLog("closedDeviceFactoryUi: devIdList: %s", devIdList)
                 dev = indigo.devices[devIdList[0]]
                 if dev:
-                    deviceDict = self.vera.devices[int(valuesDict["veraDeviceId"])]
                     deviceTypeMap = veralib.modelForDeviceInfo(deviceDict)
                     dev.model = deviceTypeMap[1]
                     dev.replaceOnServer()
@@ -131,14 +288,15 @@ class Plugin(indigo.PluginBase):
                     if "batterylevel" in deviceDict:
                         props["SupportsBatteryLevel"] = True
                     props["address"] = valuesDict["veraDeviceId"]
+                    props["controller"] = controllerId
                     dev.replacePluginPropsOnServer(props)
                     indigo.device.changeDeviceTypeId(dev, deviceTypeMap[0])
             else:
                 # this is the first time the device has been created
-                deviceDict = self.vera.devices[int(valuesDict["veraDeviceId"])]
                 deviceTypeMap = veralib.modelForDeviceInfo(deviceDict)
-                self.debugLog("closedDeviceFactoryUi: creating device for: %s" % str(deviceDict))
+                self.debugLog("closedDeviceFactoryUi: creating device for: %s", deviceDict)
                 newProps = indigo.Dict()
+                newProps["controller"] = controllerId
                 if "watts" in deviceDict:
                     self.debugLog("closedDeviceFactoryUi: entered watts block")
                     newProps["SupportsEnergyMeterCurPower"] = True
@@ -152,135 +310,266 @@ class Plugin(indigo.PluginBase):
                         deviceTypeId=deviceTypeMap[0],
                         props=newProps,
                         name=self.getUniqueDeviceName(deviceDict["name"]))
-                    self.debugLog("closedDeviceFactoryUi: finished device for: %s" % str(dev))
+                    self.debugLog("closedDeviceFactoryUi: finished device for: %s", dev)
 
     ########################################
     def validatePrefsConfigUi(self, valuesDict):
         errorsDict = indigo.Dict()
-        if "host" not in valuesDict:
-            errorsDict["host"] = 'You must specify a host name or IP address for your Vera.'
+        simulate = valuesDict.get("simulate", False)
+        if simulate:
+            try:
+                if int(valuesDict.get("simulatedDevices", verasim.kDefaultDeviceCount)) < 1:
+                    errorsDict["simulatedDevices"] = "The number of simulated devices must be 1 or more."
+            except ValueError:
+                errorsDict["simulatedDevices"] = "The number of simulated devices must be 1 or more."
+            try:
+                if float(valuesDict.get("simulatedChangeRate", verasim.kDefaultChangeRate)) < 0:
+                    errorsDict["simulatedChangeRate"] = "The change rate must be a number of changes a second (0 or more)."
+            except ValueError:
+                errorsDict["simulatedChangeRate"] = "The change rate must be a number of changes a second (0 or more)."
         else:
-            host = valuesDict["host"]
-            if not isValidHostname(valuesDict["host"]):
+            if "host" not in valuesDict:
+                errorsDict["host"] = 'You must specify a host name or IP address for your Vera.'
+            elif not isValidHostname(valuesDict["host"]):
                 errorsDict["host"] = 'You must specify a valid host name or IP address for your Vera.'
-        if "port" not in valuesDict:
-            errorsDict["host"] = 'You must specify a port number for your Vera. "%s" is the default port number for the Vera.' % kPort
-        else:
-            port = valuesDict["port"]
-            try:
-                portNumber = int(port)
-                if portNumber > 65535 or portNumber < 1:
+            if "port" not in valuesDict:
+                errorsDict["host"] = 'You must specify a port number for your Vera. "%s" is the default port number for the Vera.' % kPort
+            else:
+                port = valuesDict["port"]
+                try:
+                    portNumber = int(port)
+                    if portNumber > 65535 or portNumber < 1:
+                        errorsDict["port"] = "Invalid port number specified"
+                except:
                     errorsDict["port"] = "Invalid port number specified"
-            except:
-                errorsDict["port"] = "Invalid port number specified"
+        try:
+            parseControllerList(valuesDict.get("additionalControllers", ""))
+        except ValueError:
+            errorsDict["additionalControllers"] = "Each additional Vera must be a valid host name or IP address, optionally followed by a colon and a port number."
+        try:
+            if int(valuesDict.get("commandPacing", kCommandPacing)) < 0:
+                errorsDict["commandPacing"] = "The command pacing must be a number of milliseconds (0 or more)."
+        except ValueError:
+            errorsDict["commandPacing"] = "The command pacing must be a number of milliseconds (0 or more)."
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
         else:
-            self.host = host
-            self.port = portNumber
-            if host == "127.0.0.1" or host == "localhost":
-                # We want to run the plugin in demo mode - never try to do any comm but just set
-                # device values directly.
-                self.demoMode = True
-                return (True, valuesDict)
-            try:
-                if self.vera and self.vera.isAlive():
-                    self.vera.stop()
-                self.sleep(5)
-                self.debugLog("trying to create vera thread...")
-                self.vera = veralib.Vera(self.host, self.port, indigo.server.log, self.debugLog)
-                self.vera.threadDebug = valuesDict.get("threadDebug", False)
-                self.restartVera = True
-                self.debugLog("validatePrefsConfigUi: valuesDict: %s" % str(valuesDict))
-                return (True, valuesDict)
-            except Exception:
-                errorsDict["host"] = "Host or port are not valid or the Vera is unreachable."
-                errorsDict["port"] = "Host or port are not valid or the Vera is unreachable."
-                self.debugLog("validatePrefsConfigUi: can't start vera thread: %s" % traceback.format_exc(10))
-                return (False, valuesDict, errorsDict)
+            # Only the vera threads whose settings changed are stopped, runConcurrentThread starts new ones for them
+            # (and for any Veras that were added) in the background.
+            controllers = self._controllersFromPrefs(valuesDict)
+            with self.controllerLock:
+                for controllerId, vera in self.veras.items():
+                    if controllers.get(controllerId, None) == self.controllers.get(controllerId, None) and self._controllerSettings(controllerId, valuesDict) == self._controllerSettings(controllerId, self.controllerPrefs):
+                        vera.setThreadDebug(valuesDict.get("threadDebug", False))
+                        continue
+                    vera.stop()
+                    del self.veras[controllerId]
+                    self.stoppedVeras.append(vera)
+                    self._dropPendingStates(controllerId)
+                self.controllers = controllers
+                self.controllerPrefs = valuesDict
+            self.debugLog("validatePrefsConfigUi: valuesDict: %s", valuesDict)
+            return (True, valuesDict)
 
     ########################################
     def deviceStartComm(self, dev):
-        self.debugLog("deviceStartComm called with: device.address: %s" % dev.address)
-        if self.vera:
-            self.vera.doFullUpdate()
+        self.debugLog("deviceStartComm called with: device.address: %s", dev.address)
+        # picks up states added to Devices.xml since the device was created
+        dev.stateListOrDisplayStateIdChanged()
+        self.stateCache.pop(dev.id, None)
+        self.pendingStates.pop(dev.id, None)
+        self._updateStatesOnServer(dev, [{'key': 'commandPending', 'value': False}])
+        if dev.address:
+            # The device needs all of its states, not just the ones that change from here on. The vera thread usually
+            # already has them, otherwise a burst of these gets folded into a single full update. Before the first
+            # full update has finished there's nothing to do since it will send every device anyway.
+            with self.controllerLock:
+                vera = self._veraForDevice(dev)
+                if vera is None:
+                    self.devicesAwaitingVera.add((self._controllerForDevice(dev), dev.address))
+                elif vera.lastFullUpdate:
+                    self._resendDevices(vera, [dev.address])
         if dev.id not in self.deviceDict:
             if dev.configured:
-                self.deviceDict[dev.address] = dev.id
+                self.deviceDict[(self._controllerForDevice(dev), dev.address)] = dev.id
                 self.debugLog(dev.name + " communication enabled")
             else:
                 indigo.device.enable(dev, value=False)
                 self.errorLog(dev.name + " automatically disabled as no device type is set (see device configuration)")
                 return
-        self.debugLog("deviceStartComm: self.deviceDict: %s" % str(self.deviceDict))
+        self.debugLog("deviceStartComm: self.deviceDict: %s", self.deviceDict)
 
     ########################################
     def deviceStopComm(self, dev):
-        self.debugLog("deviceStopComm called with: device.address: %s" % dev.address)
-        if dev.address in self.deviceDict:
-            del self.deviceDict[dev.address]
+        self.debugLog("deviceStopComm called with: device.address: %s", dev.address)
+        self.stateCache.pop(dev.id, None)
+        self.pendingStates.pop(dev.id, None)
+        deviceKey = (self._controllerForDevice(dev), dev.address)
+        self.devicesAwaitingVera.discard(deviceKey)
+        if deviceKey in self.deviceDict:
+            del self.deviceDict[deviceKey]
             if self.debug:
                 indigo.server.log(dev.name + " communication disabled")
 
+    ########################################
+    def _createVera(self, controllerId, host, port, prefs):
+        commandPacing = int(prefs.get("commandPacing", kCommandPacing)) / 1000.0
+        # a new traffic log every time the thread is created so recordings don't overwrite each other
+        recordPath = None
+        if prefs.get("recordTraffic", False):
+            recordPath = self._dataPath("vera-%s-%i-%s.traffic.gz" % (host, port, time.strftime("%Y%m%d-%H%M%S")))
+        options = {
+            "standardLogMethod": indigo.server.log,
+            # the vera thread keeps its own flight recorder, so its messages skip the plugin's
+            "debugLogMethod": super(Plugin, self).debugLog,
+            "longPoll": prefs.get("longPoll", True),
+            "updateQueue": self.updateQueue,
+            "controllerId": controllerId,
+            "commandPacing": commandPacing,
+            "snapshotPath": self._dataPath("vera-%s-%i.snapshot" % (host, port)),
+            "recordPath": recordPath,
+            "flightRecorderPath": self._dataPath("vera-%s-%i.recent.log" % (host, port)),
+        }
+        if controllerId == kPrimaryController and prefs.get("simulate", False):
+            vera = verasim.SimulatedVera(int(prefs.get("simulatedDevices", verasim.kDefaultDeviceCount)), float(prefs.get("simulatedChangeRate", verasim.kDefaultChangeRate)), **options)
+        else:
+            vera = veralib.Vera(host, port, **options)
+        vera.threadDebug = prefs.get("threadDebug", False)
+        return vera
+
+    ########################################
+    def _dataPath(self, fileName):
+        # each Vera's device and scene inventory is kept between runs in the plugin's preferences folder, along with
+        # any traffic logs
+        try:
+            folder = os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins", self.pluginId)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            return os.path.join(folder, fileName)
+        except Exception:
+            self.debugLog("can't set up the plugin's data folder: %s", traceback.format_exc(10))
+            return None
+
+    ########################################
+    def _startControllers(self):
+        # Creates and starts a vera thread for every configured Vera that doesn't have one. Connecting to the Vera
+        # happens in the background on its thread, which reports how that's going with connectionState updates.
+        with self.controllerLock:
+            self.stoppedVeras = [vera for vera in self.stoppedVeras if vera.isAlive()]
+            for controllerId, (host, port) in self.controllers.items():
+                vera = self.veras.get(controllerId, None)
+                if not vera:
+                    # a thread that's being replaced saves its snapshot on the way out, and the new one for the same
+                    # Vera would read it (and write the same file) so it has to wait until the old one is done
+                    if not self._waitForStoppedVeras(host, port):
+                        continue
+                    vera = self._createVera(controllerId, host, port, self.controllerPrefs)
+                    self.veras[controllerId] = vera
+                    # The optimistic states the old thread dropped are replaced by the last state it saved for those
+                    # devices, and then by whatever the Vera says now in case that's changed since.
+                    for staleDevice in [staleDevice for staleDevice in self.staleDevices if staleDevice[0] == controllerId]:
+                        self.staleDevices.discard(staleDevice)
+                        if vera.resendDevice(int(staleDevice[1])):
+                            vera.refreshDevice(int(staleDevice[1]))
+                        else:
+                            vera.scheduleFullUpdate()
+                    # The snapshot it just loaded has the states of the devices that were waiting for it. Without one
+                    # its first full update sends every device anyway.
+                    waitingDevices = [deviceKey for deviceKey in self.devicesAwaitingVera if deviceKey[0] == controllerId]
+                    self.devicesAwaitingVera.difference_update(waitingDevices)
+                    if vera.lastFullUpdate:
+                        self._resendDevices(vera, [address for deviceController, address in waitingDevices])
+                if vera.ident is None:
+                    vera.start()
+                    self.debugLog("runConcurrentThread: started thread for %s", host)
+
+    ########################################
+    def _resendDevices(self, vera, addresses):
+        # the devices the vera thread doesn't know about all go in a single full update
+        resent = [vera.resendDevice(int(address)) for address in addresses]
+        if not all(resent):
+            vera.scheduleFullUpdate()
+
+    ########################################
+    def _waitForStoppedVeras(self, host, port):
+        for vera in [vera for vera in self.stoppedVeras if (vera.address, vera.port) == (host, port)]:
+            vera.join(kThreadStopWait)
+            if vera.isAlive():
+                self.debugLog("_startControllers: still waiting for the old thread for %s to stop", host)
+                return False
+            self.stoppedVeras.remove(vera)
+        return True
+
     ########################################
     def runConcurrentThread(self):
         self.debugLog("Starting concurrent tread")
         try:
             while True:
-                if not self.host:
+                if not self.controllers:
                     self.sleep(3)
                     continue
-                failCount = 0
-                while not self.vera and not self.demoMode:
-                    try:
-                        self.vera = veralib.Vera(self.host, self.port, indigo.server.log, self.debugLog)
-                        self.restartVera = True
-                        self.vera.threadDebug = self.pluginPrefs.get("threadDebug", False)
-                    except self.StopThread:
+                self._startControllers()
+                # block until one of the vera threads has something for us so updates are processed as soon as they
+                # arrive
+                self._publishMetricsIfDue()
+                self._expirePendingStates()
+                try:
+                    updateDict = self.updateQueue.get(True, kUpdateWaitTimeout)
+                except Queue.Empty:
+                    if self.stopThread:
                         raise self.StopThread
-                    except:
-                        if failCount < 1 or (failCount >= kFailCountTrigger):
-                            self.errorLog("Can't communicate with the Vera - make sure the plugin settings are correct and that the Vera is running and accessible.")
-                            self.errorLog("Will continue to retry every 15 seconds silently.")
-                            if failCount >= kFailCountTrigger:
-                                failCount = 0
-                        failCount += 1
-                        self.sleep(15)
-                if self.vera and self.restartVera and not self.demoMode:
-                    errorNeedsDisplay = True
-                    while not self.vera.isAlive():
-                        try:
-                            self.vera.start()
-                            self.debugLog("runConcurrentThread: started thread")
-                            self.vera.commandQueue = Queue.Queue()
-                            self.vera.doFullUpdate()
-                            self.restartVera = False
-                        except self.StopThread:
-                            self.debugLog("runConcurrentThread: vera start loop got StopThread")
-                            raise self.StopThread
-                        except Exception, e:
-                            self.debugLog("Vera thread can't start, will continue to retry: %s" % str(e))
-                            if errorNeedsDisplay:
-                                self.errorLog("Vera thread can't start, will continue to retry silently every 15 seconds: %s" % str(e))
-                            self.sleep(15)
-                if self.vera and self.vera.isAlive() and not self.demoMode:
-                    queueHasItems = True
-                    while self.vera and self.vera.updateQueue and queueHasItems:
-                        try:
-                            updateDict = self.vera.updateQueue.get_nowait()
-                            self.debugLog("runConcurrentThread: processing update: %s" % str(updateDict))
-                            self.processUpdate(updateDict)
-                            self.commandQueue.task_done()
-                        except self.StopThread:
-                            raise self.StopThread
-                        except:
-                            queueHasItems = False
-                    self.sleep(3)
-                elif self.demoMode:
-                    self.sleep(3)
+                    continue
+                startTime = time.time()
+                try:
+                    self.debugLog("runConcurrentThread: processing update: %s", updateDict)
+                    self.processUpdate(updateDict)
+                except Exception:
+                    self.metrics.count("updateErrors")
+                    self.flightRecorder.record(u"error processing an update: %s", (traceback.format_exc(10),), True)
+                    self.logger.exception(u"Error encountered processing an update")
+                    self._saveFlightRecorderAfterError()
+                finally:
+                    self.updateQueue.task_done()
+                    self.metrics.count("updatesProcessed")
+                    self.metrics.record("processUpdateTime", (time.time() - startTime) * 1000)
         except self.StopThread:
-            if self.vera and self.vera.isAlive() and not self.demoMode:
-                self.vera.stop()
+            for vera in self.veras.values():
+                if vera.isAlive():
+                    vera.stop()
+            self._dropPendingStates()
+
+    ########################################
+    def _publishMetricsIfDue(self):
+        # Keeps the metrics variables up to date when they're turned on. Variables only get written when their value
+        # changes so triggers on them don't fire for nothing.
+        if not self.pluginPrefs.get("publishMetrics", False) or time.time() - self.lastMetricsPublished < kMetricsPublishInterval:
+            return
+        self.lastMetricsPublished = time.time()
+        metrics = []
+        pluginValues = self.metrics.values()
+        for name in kPublishedPluginMetrics:
+            metrics.append(("veraBridge_%s" % name, pluginValues.get(name, 0)))
+        for controllerId, vera in self.veras.items():
+            veraValues = vera.metrics.values()
+            prefix = "veraBridge_%s_" % re.sub(r"\W", "_", "%s_%i" % (vera.address, vera.port))
+            for name in kPublishedVeraMetrics:
+                metrics.append((prefix + name, veraValues.get(name, 0)))
+        try:
+            if kMetricsVariableFolder in indigo.variables.folders:
+                folderId = indigo.variables.folders[kMetricsVariableFolder].id
+            else:
+                folderId = indigo.variables.folder.create(kMetricsVariableFolder).id
+            for name, value in metrics:
+                value = u"%s" % (round(value, 1) if isinstance(value, float) else value)
+                if self.publishedMetrics.get(name, None) == value:
+                    continue
+                if name in indigo.variables:
+                    indigo.variable.updateValue(indigo.variables[name], value)
+                else:
+                    indigo.variable.create(name, value=value, folder=folderId)
+                self.publishedMetrics[name] = value
+        except Exception:
+            self.errorLog("Can't publish the metrics variables: %s" % traceback.format_exc(10))
 
     ########################################
     def processUpdate(self, updateDict):
@@ -290,18 +579,21 @@ class Plugin(indigo.PluginBase):
             #update the states
             deviceInfo = updateDict["device"]
             devAddress = deviceInfo.get("id", -1)
-            devId = self.deviceDict.get(str(devAddress), 0)
+            devId = self.deviceDict.get((updateDict.get("controller", kPrimaryController), str(devAddress)), 0)
             dev = indigo.devices.get(devId, None)
             keyValueList = []
             if dev and dev.enabled:
                 try:
-                    self.debugLog("processUpdate start: found device (%s) updating: %s" % (dev.name, deviceInfo))
+                    self.debugLog("processUpdate start: found device (%s) updating: %s", dev.name, deviceInfo)
                     # This first set of if/elif will take care of dimmers, locks, and relays.
                     if "level" in deviceInfo:
                         keyValueList.append({'key': 'brightnessLevel', 'value': deviceInfo["level"]})
                     elif "locked" in deviceInfo:
                         keyValueList.append({'key': 'onOffState', 'value': bool(int(deviceInfo["locked"]))})
-                    elif "status" in deviceInfo and dev.deviceTypeId != "veraThermostat":  # some versions of the API send an erroneous status for thermostats which have no on/off state
+                    # Updates only carry the fields that changed, so a dimmer or lock can show up with a status but no
+                    # level/locked value. Their on/off state comes from level/locked so status is ignored for them.
+                    # Some versions of the API also send an erroneous status for thermostats which have no on/off state.
+                    elif "status" in deviceInfo and dev.deviceTypeId not in ("veraThermostat", "veraDimmer", "veraLock"):
                         keyValueList.append({'key': 'onOffState', 'value': bool(int(deviceInfo["status"]))})
 
                     # Next, we deal with thermostat and other values
@@ -325,35 +617,171 @@ class Plugin(indigo.PluginBase):
                         uiString = ("%2.3f kWh" % float(deviceInfo["kwh"]))
                         keyValueList.append({'key': 'accumEnergyTotal', 'value': deviceInfo["kwh"], 'uiValue': uiString})
 
-                    # Now we can process keyValueList and update all the device states
+                    # Now we can process keyValueList and update the device states that actually changed
+                    keyValueList = self._holdPendingStates(dev, keyValueList)
                     if len(keyValueList) > 0:
-                        dev.updateStatesOnServer(keyValueList)
+                        self._updateStatesOnServer(dev, keyValueList)
 
                     # And, finaly, check to see if the device is in an error state
                     if "state" in deviceInfo:
                         if deviceInfo["state"] in veralib.kErrorStates:
                             dev.setErrorStateOnServer("device error")
 
-                    self.debugLog("processUpdate Finished: for device (%s)  : %s" % (dev.name, deviceInfo))
+                    self.debugLog("processUpdate Finished: for device (%s)  : %s", dev.name, deviceInfo)
 
                 except Exception:
+                    self.flightRecorder.record(u"error in processUpdate: %s", (traceback.format_exc(10),), True)
                     self.logger.exception(u"Error encountered in processUpdate")
+                    self._saveFlightRecorderAfterError()
                     return
             else:
                 if dev:
-                    self.debugLog("processUpdate: device with Vera ID %i found (%s) but is disabled, skipping update" % (devAddress, dev.name))
+                    self.debugLog("processUpdate: device with Vera ID %i found (%s) but is disabled, skipping update", devAddress, dev.name)
                 else:
-                    self.debugLog("processUpdate: no device with Vera ID %i found, skipping update" % devAddress)
+                    self.debugLog("processUpdate: no device with Vera ID %i found, skipping update", devAddress)
         elif updateType == "deleteDevice":
             self.debugLog("\n\nDELETING DEVICE\n\n")
             # the device disappeared from the vera so we'll want to deal with it
             devAddress = updateDict.get("device", -1)
-            self.debugLog("deleting device id: %s" % str(devAddress))
-            devId = self.deviceDict.get(str(devAddress), 0)
+            self.debugLog("deleting device id: %s", devAddress)
+            devId = self.deviceDict.get((updateDict.get("controller", kPrimaryController), str(devAddress)), 0)
             dev = indigo.devices.get(devId, None)
             if dev:
+                # whatever was queued for the device won't be sent, so it goes back to how the Vera last showed it
+                self._rollBackPendingStates(dev)
                 dev.setErrorStateOnServer("device deleted")
                 self.errorLog('Device "%s" (id: %s) deleted on the Vera' % (dev.name, devAddress))
+        elif updateType == "connectionState":
+            self._processConnectionState(updateDict.get("controller", kPrimaryController), updateDict["state"], updateDict["previousState"])
+        elif updateType in ("commandConfirmed", "commandUnconfirmed"):
+            # the vera thread tells us whether each command it sent actually showed up in the device's state
+            devAddress = updateDict.get("device", -1)
+            devId = self.deviceDict.get((updateDict.get("controller", kPrimaryController), str(devAddress)), 0)
+            dev = indigo.devices.get(devId, None)
+            if dev:
+                if updateType == "commandConfirmed":
+                    self.debugLog(u"\"%s\" %s confirmed (job %s)", dev.name, updateDict["command"], updateDict.get("jobId", None))
+                else:
+                    self.errorLog(u"\"%s\" %s to %s wasn't confirmed: %s" % (dev.name, updateDict["command"], updateDict["value"], updateDict.get("reason", "")))
+                self._resolvePendingState(dev, kOptimisticStateKeys.get(updateDict["key"], None), updateType == "commandConfirmed")
+
+    ########################################
+    def _processConnectionState(self, controllerId, state, previousState):
+        host = self.controllers.get(controllerId, (controllerId, 0))[0]
+        if state == veralib.kConnectionState_Down:
+            self.errorLog("Can't communicate with the Vera at %s - make sure the plugin settings are correct and that the Vera is running and accessible. Will continue to retry silently." % host)
+        elif state == veralib.kConnectionState_Degraded:
+            self.debugLog("The Vera at %s isn't answering, retrying", host)
+        elif state == veralib.kConnectionState_Connected and previousState == veralib.kConnectionState_Down:
+            indigo.server.log("Reconnected to the Vera at %s" % host)
+        # the Vera's devices show an error while it's down
+        for dev in indigo.devices.iter("self"):
+            if dev.enabled and self._controllerForDevice(dev) == controllerId:
+                if state == veralib.kConnectionState_Down:
+                    dev.setErrorStateOnServer(u"no comm")
+                elif state == veralib.kConnectionState_Connected and dev.errorState == u"no comm":
+                    dev.setErrorStateOnServer(None)
+
+    ########################################
+    def _applyOptimisticState(self, dev, key, value):
+        # Shows what a command is about to do right away instead of waiting for the Vera to report it. It has to be
+        # called before the command is queued, since the vera thread can confirm a command as soon as it's sent. The
+        # state stays pending until the vera thread confirms the command or gives up on it, and in the meantime
+        # reported values that don't match are held back (see _holdPendingStates).
+        pendingStates = self.pendingStates.setdefault(dev.id, {})
+        if key in pendingStates:
+            # a newer command for the same state keeps what the first one would have gone back to
+            pendingStates[key]["deadline"] = time.time() + kPendingStateTimeout
+        else:
+            pendingStates[key] = {"value": dev.states.get(key, None), "deadline": time.time() + kPendingStateTimeout}
+        self._updateStatesOnServer(dev, [{'key': key, 'value': value}, {'key': 'commandPending', 'value': True}])
+
+    ########################################
+    def _holdPendingStates(self, dev, keyValueList):
+        # A reported value for a pending state that doesn't match what the command should do becomes the value to go
+        # back to instead of being shown. Reports carry the Vera's strings ("50") and the optimistic states Indigo's
+        # values (50), so they're compared the way the vera thread confirms commands.
+        pendingStates = self.pendingStates.get(dev.id, None)
+        if not pendingStates:
+            return keyValueList
+        heldList = []
+        for keyValue in keyValueList:
+            if keyValue["key"] in pendingStates and not veralib.stateValuesMatch(dev.states.get(keyValue["key"], None), keyValue["value"]):
+                pendingStates[keyValue["key"]]["value"] = keyValue["value"]
+            else:
+                heldList.append(keyValue)
+        return heldList
+
+    ########################################
+    def _resolvePendingState(self, dev, key, confirmed):
+        pendingStates = self.pendingStates.get(dev.id, {})
+        if key not in pendingStates:
+            return
+        rollbackValue = pendingStates.pop(key)["value"]
+        keyValueList = []
+        if not confirmed and rollbackValue is not None:
+            keyValueList.append({'key': key, 'value': rollbackValue})
+        if not pendingStates:
+            del self.pendingStates[dev.id]
+            keyValueList.append({'key': 'commandPending', 'value': False})
+        self._updateStatesOnServer(dev, keyValueList)
+
+    ########################################
+    def _expirePendingStates(self):
+        # Rolls back optimistic states whose command was never confirmed or failed, say because the vera thread died
+        # with it. Without this the device would show commandPending forever and keep holding back reports.
+        # This runs for every update processed, so a device is only fetched from the server once one of its states is
+        # actually overdue.
+        now = time.time()
+        for devId, pendingStates in self.pendingStates.items():
+            expiredKeys = [key for key, pendingState in pendingStates.iteritems() if pendingState["deadline"] <= now]
+            if not expiredKeys:
+                continue
+            dev = indigo.devices.get(devId, None)
+            if dev is None:
+                del self.pendingStates[devId]
+                continue
+            for key in expiredKeys:
+                self.errorLog(u"\"%s\" %s wasn't confirmed in time, showing the last reported value" % (dev.name, key))
+                self._resolvePendingState(dev, key, False)
+
+    ########################################
+    def _rollBackPendingStates(self, dev):
+        for key in self.pendingStates.get(dev.id, {}).keys():
+            self._resolvePendingState(dev, key, False)
+
+    ########################################
+    def _clearPendingStates(self, dev):
+        # forgets the device's pending states without rolling them back, for when nothing is left to confirm them
+        if self.pendingStates.pop(dev.id, None) is not None:
+            self._updateStatesOnServer(dev, [{'key': 'commandPending', 'value': False}])
+
+    ########################################
+    def _dropPendingStates(self, controllerId=None):
+        # The vera threads are being stopped (just the one for controllerId if it's given), and the commands they had
+        # go with them. The devices get whatever the next thread for their Vera last knew about them instead (see
+        # _startControllers).
+        for devId in self.pendingStates.keys():
+            dev = indigo.devices.get(devId, None)
+            if dev is None:
+                del self.pendingStates[devId]
+                continue
+            if controllerId is not None and self._controllerForDevice(dev) != controllerId:
+                continue
+            self.staleDevices.add((self._controllerForDevice(dev), dev.address))
+            self._clearPendingStates(dev)
+
+    ########################################
+    def _updateStatesOnServer(self, dev, keyValueList):
+        # Each write is a round trip to the Indigo server, so only send the states whose value or uiValue differs from
+        # what we last wrote for the device and skip the call entirely when nothing changed.
+        lastStates = self.stateCache.setdefault(dev.id, {})
+        changedList = [keyValue for keyValue in keyValueList if lastStates.get(keyValue["key"], None) != (keyValue["value"], keyValue.get("uiValue", None))]
+        if len(changedList) > 0:
+            dev.updateStatesOnServer(changedList)
+            for keyValue in changedList:
+                lastStates[keyValue["key"]] = (keyValue["value"], keyValue.get("uiValue", None))
+        return changedList
 
     ########################################
     def getUniqueDeviceName(self, seedName):
@@ -382,11 +810,13 @@ class Plugin(indigo.PluginBase):
 
         ###### ENERGY UPDATE ######
         elif action.deviceAction == indigo.kUniversalAction.EnergyUpdate:
-            self.debugLog(u"received request for \"%s\" %s" % (dev.name, action))
+            self.debugLog(u"received request for \"%s\" %s", dev.name, action)
             # dev=indigo.devices[action.deviceId] # "Bergerie Patio Light"
-            self.debugLog(u"found device \"%s %s" % (dev.name, dev.address))
+            self.debugLog(u"found device \"%s %s", dev.name, dev.address)
             # Request hardware module (dev) for its most recent meter data here:
-            self.vera._update(fullUpdate=False, updateDevAddress=dev.address)
+            vera = self._veraForDevice(dev)
+            if vera:
+                vera.refreshDevice(int(dev.address))
 
             #self._refreshStatesFromHardware(dev, True)
 
@@ -396,8 +826,10 @@ class Plugin(indigo.PluginBase):
             indigo.server.log(u"received request for \"%s\" %s" % (dev.name, "energy usage reset"))
             # Just ell Indigo to reset it by setting the value to 0.
             # This will automatically reset Indigo's time stamp for the accumulation.
-            self.vera._kwhReset(dev.address)
-            dev.updateStateOnServer("accumEnergyTotal", 0.0)
+            vera = self._veraForDevice(dev)
+            if vera:
+                vera._kwhReset(dev.address)
+            self._updateStatesOnServer(dev, [{'key': 'accumEnergyTotal', 'value': 0.0}])
 
         ###### STATUS REQUEST ######
         elif action.deviceAction == indigo.kUniversalAction.RequestStatus:
@@ -407,65 +839,54 @@ class Plugin(indigo.PluginBase):
             self.updateAll()
 
     def actionControlDimmerRelay(self, action, dev):
-        if (self.vera and self.vera.isAlive() and self.vera.commandQueue and dev.enabled) or self.demoMode:
+        vera = self._veraForDevice(dev)
+        if vera and vera.isAlive() and dev.enabled:
             if dev.deviceTypeId == "veraLock":
                 if action.deviceAction == indigo.kDeviceAction.TurnOff:
-                    if self.demoMode:
-                        self.sleep(1.5)
-                        dev.updateStateOnServer(key="onOffState", value=False)
-                    else:
-                        self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Unlock})
+                    self._applyOptimisticState(dev, 'onOffState', False)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Unlock})
                 elif action.deviceAction == indigo.kDeviceAction.TurnOn:
-                    if self.demoMode:
-                        self.sleep(1.5)
-                        dev.updateStateOnServer(key="onOffState", value=True)
-                    else:
-                        self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Lock})
+                    self._applyOptimisticState(dev, 'onOffState', True)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Lock})
                 elif action.deviceAction == indigo.kDeviceAction.Toggle:
-                    if self.demoMode:
-                        self.sleep(1.5)
-                        dev.updateStateOnServer(key="onOffState", value=not dev.onState)
-                    else:
-                        if dev.onState:
-                            self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Unlock})
-                        else:
-                            self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Lock})
+                    turnOn = not dev.onState
+                    self._applyOptimisticState(dev, 'onOffState', turnOn)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_Lock if turnOn else veralib.kCommand_Unlock})
             else:
-                if self.demoMode:
-                        self.errorLog("Only lock devices are supported in demo mode.")
-                        return
                 if action.deviceAction == indigo.kDeviceAction.TurnOff:
-                    self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOff})
+                    self._applyOptimisticState(dev, 'onOffState', False)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOff})
                 elif action.deviceAction == indigo.kDeviceAction.TurnOn:
-                    self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOn})
+                    self._applyOptimisticState(dev, 'onOffState', True)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOn})
                 elif action.deviceAction == indigo.kDeviceAction.Toggle:
-                    if dev.onState:
-                        self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOff})
-                    else:
-                        self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOn})
+                    turnOn = not dev.onState
+                    self._applyOptimisticState(dev, 'onOffState', turnOn)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_TurnOn if turnOn else veralib.kCommand_TurnOff})
                 elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
-                    self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": action.actionValue})
+                    self._applyOptimisticState(dev, 'brightnessLevel', action.actionValue)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": action.actionValue})
                 elif action.deviceAction == indigo.kDeviceAction.BrightenBy:
                     newBrightness = dev.brightness + action.actionValue
                     if newBrightness == 0:
                         newBrightness = action.actionValue
                     if newBrightness > 100:
                         newBrightness = 100
-                    self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": newBrightness})
+                    self._applyOptimisticState(dev, 'brightnessLevel', newBrightness)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": newBrightness})
                 elif action.deviceAction == indigo.kDeviceAction.DimBy:
                     newBrightness = dev.brightness - action.actionValue
                     if newBrightness < 0:
                         newBrightness = 0
-                    self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": newBrightness})
+                    self._applyOptimisticState(dev, 'brightnessLevel', newBrightness)
+                    vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetBrightness, "value": newBrightness})
         else:
             self.errorLog("Command not sent - either the device is disabled or the vera communication thread isn't running.")
 
     def actionControlThermostat(self, action, dev):
-        if self.demoMode:
-            self.errorLog("Only lock devices are supported in demo mode.")
-            return
-        if self.vera and self.vera.isAlive() and self.vera.commandQueue and dev.enabled:
-            self.debugLog("actionControlThermostat: device id: %s, action: %s" % (dev.address, str(action.thermostatAction)))
+        vera = self._veraForDevice(dev)
+        if vera and vera.isAlive() and dev.enabled:
+            self.debugLog("actionControlThermostat: device id: %s, action: %s", dev.address, action.thermostatAction)
             ###### SET HVAC MODE ######
             if action.thermostatAction == indigo.kThermostatAction.SetHvacMode:
                 id = int(dev.address)
@@ -480,8 +901,9 @@ class Plugin(indigo.PluginBase):
                 else:
                     self.errorLog("actionControlThermostat: Set HVAC mode action has an invalid action mode")
                     return
-                self.debugLog("actionControlThermostat: set havc mode vera command: %s" % command)
-                self.vera.commandQueue.put_nowait({"id": id, "command": veralib.kCommand_SetThermostatMode, "value": command})
+                self.debugLog("actionControlThermostat: set havc mode vera command: %s", command)
+                self._applyOptimisticState(dev, 'hvacOperationMode', kThermostatModeLookup[command])
+                vera.commandQueue.put_nowait({"id": id, "command": veralib.kCommand_SetThermostatMode, "value": command})
 
             ###### SET FAN MODE ######
             elif action.thermostatAction == indigo.kThermostatAction.SetFanMode:
@@ -492,61 +914,65 @@ class Plugin(indigo.PluginBase):
                 else:
                     self.errorLog("actionControlThermostat: Set fan mode action has an invalid action mode")
                     return
-                self.debugLog("actionControlThermostat: set fan mode vera command: %s" % command)
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetThermostatFanMode, "value": command})
+                self.debugLog("actionControlThermostat: set fan mode vera command: %s", command)
+                self._applyOptimisticState(dev, 'hvacFanMode', kThermostatFanLookup[command])
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetThermostatFanMode, "value": command})
 
             ###### SET COOL SETPOINT ######
             elif action.thermostatAction == indigo.kThermostatAction.SetCoolSetpoint:
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": action.actionValue})
+                self._applyOptimisticState(dev, 'setpointCool', int(action.actionValue))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": action.actionValue})
 
             ###### SET HEAT SETPOINT ######
             elif action.thermostatAction == indigo.kThermostatAction.SetHeatSetpoint:
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": action.actionValue})
+                self._applyOptimisticState(dev, 'setpointHeat', int(action.actionValue))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": action.actionValue})
 
             ###### DECREASE/INCREASE COOL SETPOINT ######
             elif action.thermostatAction == indigo.kThermostatAction.DecreaseCoolSetpoint:
                 newSetpoint = dev.coolSetpoint - action.actionValue
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": int(newSetpoint)})
+                self._applyOptimisticState(dev, 'setpointCool', int(newSetpoint))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": int(newSetpoint)})
 
             elif action.thermostatAction == indigo.kThermostatAction.IncreaseCoolSetpoint:
                 newSetpoint = dev.coolSetpoint + action.actionValue
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": int(newSetpoint)})
+                self._applyOptimisticState(dev, 'setpointCool', int(newSetpoint))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetCoolSetpoint, "value": int(newSetpoint)})
 
             ###### DECREASE/INCREASE HEAT SETPOINT ######
             elif action.thermostatAction == indigo.kThermostatAction.DecreaseHeatSetpoint:
                 newSetpoint = dev.heatSetpoint - action.actionValue
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": int(newSetpoint)})
+                self._applyOptimisticState(dev, 'setpointHeat', int(newSetpoint))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": int(newSetpoint)})
 
             elif action.thermostatAction == indigo.kThermostatAction.IncreaseHeatSetpoint:
                 newSetpoint = dev.heatSetpoint + action.actionValue
-                self.vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": int(newSetpoint)})
+                self._applyOptimisticState(dev, 'setpointHeat', int(newSetpoint))
+                vera.commandQueue.put_nowait({"id": int(dev.address), "command": veralib.kCommand_SetHeatSetpoint, "value": int(newSetpoint)})
         else:
             self.errorLog("Command not sent - either the device is disabled or the vera communication thread isn't running.")
 
     ########################################
     def actionControlGeneral(self, action, dev):
         if action.deviceAction == indigo.kDeviceGeneralAction.RequestStatus:
-            if self.vera:
-                self.vera.doFullUpdate()
+            vera = self._veraForDevice(dev)
+            if vera:
+                # status requests for a bunch of devices at once only need one full update between them
+                vera.scheduleFullUpdate(resendAll=True)
             indigo.server.log(u"sent full update request - all devices will be refreshed in the next update")
 
     ########################################
     def runScene(self, action):
-        if self.demoMode:
-            self.errorLog("Scene control not available in demo mode.")
-            return
         # add the command to the vera queue
         sceneId = action.props.get("sceneId", None)
-        if sceneId:
-            self.vera.commandQueue.put_nowait({"id": int(sceneId), "command": veralib.kCommand_RunScene})
+        vera = self.veras.get(action.props.get("controller", kPrimaryController), None)
+        if sceneId and vera:
+            vera.commandQueue.put_nowait({"id": int(sceneId), "command": veralib.kCommand_RunScene})
 
     ########################################
     # Menu Methods
     ########################################
     def toggleDebugging(self):
-        if self.demoMode:
-            self.errorLog("Debug mode not available in demo mode.")
-            return
         if self.debug:
             indigo.server.log("Turning off debug logging")
             self.pluginPrefs["showDebugInfo"] = False
@@ -555,9 +981,25 @@ class Plugin(indigo.PluginBase):
             self.pluginPrefs["showDebugInfo"] = True
         self.debug = not self.debug
 
+    def showMetrics(self):
+        for line in self.metrics.report():
+            indigo.server.log(u"plugin: %s" % line)
+        for controllerId, vera in sorted(self.veras.items()):
+            for line in vera.metrics.report():
+                indigo.server.log(u"vera %s:%i: %s" % (vera.address, vera.port, line))
+
+    def saveRecentActivity(self):
+        # everything the plugin and the vera threads logged recently, debug messages included, as one timeline
+        path = self._dataPath("recent-activity-%s.log" % time.strftime("%Y%m%d-%H%M%S"))
+        recorders = [self.flightRecorder] + [vera.flightRecorder for controllerId, vera in sorted(self.veras.items())]
+        try:
+            count = veralib.saveFlightRecorders(path, recorders)
+            indigo.server.log(u"saved the last %i log messages to %s" % (count, path))
+        except Exception, e:
+            self.errorLog(u"Can't save the recent activity: %s" % str(e))
+
     def updateAll(self):
-        if self.demoMode:
-            self.errorLog("Update all not available in demo mode.")
-            return
         indigo.server.log("Starting update all")
-        self.vera._update(fullUpdate=True,)
+        # let the vera threads do the fetch so they aren't racing with their own polling
+        for vera in self.veras.values():
+            vera.doFullUpdate(resendAll=True)
@@ -3,26 +3,35 @@
 ####################
 
 import socket
+import select
+import errno
+import os
+import sys
 import threading
-import urllib2
 import httplib
+import bisect
 import traceback
+from collections import deque
+from operator import itemgetter
 from datetime import datetime, time
 import Queue
 import time
 import json
-import copy
+import re
+import zlib
+import gzip
+import random
 
 ################################################################################
 # Globals
 ################################################################################
-# if we ever want to get more details about a device, including command classes and some other junk, we can use this URL:
-#   /data_request?id=status&output_format=json&DeviceNum=5
-# the last param is the 'id' value in the lu_sdata return for each device
+# the status request returns every UPnP variable for a single device (plus command classes and some other junk), the
+# DeviceNum param is the 'id' value in the lu_sdata return for each device
 #
 kPollingUrl = u"/data_request?id=lu_sdata&output_format=json"
-kActionUrl = u"data_request?id=lu_action&output_format=json"
-kResetKwhUrl = u"data_request?id=action"
+kStatusUrl = u"/data_request?id=status&output_format=json&DeviceNum=%i"
+kActionUrl = u"/data_request?id=lu_action&output_format=json"
+kResetKwhUrl = u"/data_request?id=action"
 kRunSceneServiceString = "SceneNum=%i&serviceId=urn:micasaverde-com:serviceId:HomeAutomationGateway1&action=RunScene"
 kOnOffServiceString = "DeviceNum=%i&serviceId=urn:upnp-org:serviceId:SwitchPower1&action=SetTarget&newTargetValue=%i"
 kBrightnessServiceString = "DeviceNum=%i&serviceId=urn:upnp-org:serviceId:Dimming1&action=SetLoadLevelTarget&newLoadlevelTarget=%i"
@@ -31,9 +40,57 @@ kThermostatServiceString_HeatSetpoint = "DeviceNum=%i&serviceId=urn:upnp-org:ser
 kThermostatServiceString_CoolSetpoint = "DeviceNum=%i&serviceId=urn:upnp-org:serviceId:TemperatureSetpoint1_Cool&action=SetCurrentSetpoint&NewCurrentSetpoint=%i"
 kThermostatServiceString_Mode = "DeviceNum=%i&serviceId=urn:upnp-org:serviceId:HVAC_UserOperatingMode1&action=SetModeTarget&NewModeTarget=%s"
 kThermostatServiceString_FanMode = "DeviceNum=%i&serviceId=urn:upnp-org:serviceId:HVAC_FanOperatingMode1&action=SetMode&NewMode=%s"
+# every request gets a (connect, read) timeout pair so a Vera that's gone away fails fast while one that's just slow
+# to answer still gets a reasonable amount of time
+kConnectTimeout = 2
 kTimeout = 10
+kCommandTimeouts = (kConnectTimeout, 5)
+kPollTimeouts = (kConnectTimeout, kTimeout)
+kMaxIdleConnections = 2  # the Vera's web server only handles a few connections at a time so don't hold on to many
+kMaxConnections = 4  # at most a poll and a few commands in flight at once
+kMaxCommandsInFlight = 3
+# the default minimum time between commands, firing a big batch of them back to back overloads the Z-Wave mesh and
+# some of them get dropped
+kCommandPacing = 0.1
 kPollInterval = 30
+# after a poll fails the next one waits kRetryInterval seconds, doubling with each failure in a row up to
+# kMaxRetryInterval
+kRetryInterval = 1
+kMaxRetryInterval = 60
+# a Vera we can't poll is degraded if we were connected to it and down after this many failed polls in a row
+kDownFailureCount = 3
+kConnectionState_Connecting = "connecting"
+kConnectionState_Connected = "connected"
+kConnectionState_Degraded = "degraded"
+kConnectionState_Down = "down"
+# long poll settings: the Vera holds an lu_sdata request open for up to kLongPollTimeout seconds waiting for a
+# change, and waits at least kLongPollMinimumDelay milliseconds before answering so rapid changes get batched. The
+# delay is added to every change we hear about, so it's kept short - a burst of changes still mostly ends up in one or
+# two answers.
+kLongPollTimeout = 60
+kLongPollMinimumDelay = 250
+# if the Vera answers this many long polls in a row with nothing new and well before kLongPollTimeout, it doesn't
+# support them
+kLongPollFailureLimit = 3
+kLongPollEarlyAnswer = kLongPollTimeout / 2.0
+# give the Vera the whole long poll window plus the normal read timeout to answer
+kLongPollTimeouts = (kConnectTimeout, kLongPollTimeout + kTimeout)
 kFullUpdateInterval = 60 * 30  # do a full update every 30 minutes
+kFullUpdateDebounce = 2  # scheduled full updates wait until requests for them have stopped for this many seconds
+# the device and scene inventory is saved after every full update, at most this often after partial ones and when the
+# thread stops
+kSnapshotVersion = 1
+kSnapshotInterval = 60 * 5
+# traffic logs (see VeraTrafficRecorder) - the log is flushed at least this often so a crash loses little of it
+kTrafficLogVersion = 1
+kTrafficLogFlushInterval = 10
+# the upper bounds of the buckets metrics histograms count values into - times are in milliseconds
+kMetricsTimeBuckets = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000, 120000)
+kMetricsSizeBuckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+kMetricsCountBuckets = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+# how many of the most recent log messages a flight recorder keeps, and how often an error can save it
+kFlightRecorderSize = 2000
+kFlightRecorderSaveInterval = 60
 #  See http://wiki.micasaverde.com/index.php/Luup_Device_Categories and http://wiki.micasaverde.com/index.php/Luup_UPNP_Files for device catagory (type) information
 kSupportedDeviceTypes = [2, 3, 5, 7]
 kVeraDeviceTypeMap = {
@@ -68,6 +125,32 @@ kVeraDeviceTypeMap = {
     28: ["veraUvSensor", "UV Sensor"],
     29: ["veraMouseTrap", "Mouse Trap"]
 }
+# The lu_sdata fields kept for each device category - anything else the Vera sends is dropped when the device's record
+# is built. Every device gets kDeviceBaseFields, and categories that aren't listed get all of kDeviceSensorFields.
+kDeviceBaseFields = ("id", "name", "category", "subcategory", "room", "parent", "state", "comment", "status", "batterylevel")
+kDeviceSensorFields = ("level", "locked", "watts", "kwh", "temperature", "humidity", "light", "tripped", "armed")
+kDeviceCategoryFields = {
+    2: ("level", "watts", "kwh"),
+    3: ("watts", "kwh"),
+    5: ("temperature", "heatsp", "coolsp", "mode", "fanmode", "hvacstate"),
+    7: ("locked",),
+    27: ("watts", "kwh"),
+}
+kSceneFields = ("id", "name", "room", "active", "state", "comment")
+# maps the (service, variable) pairs in a status request to the field names lu_sdata uses for them
+kStatusVariableMap = {
+    ("urn:upnp-org:serviceId:SwitchPower1", "Status"): "status",
+    ("urn:upnp-org:serviceId:Dimming1", "LoadLevelStatus"): "level",
+    ("urn:micasaverde-com:serviceId:DoorLock1", "Status"): "locked",
+    ("urn:micasaverde-com:serviceId:EnergyMetering1", "Watts"): "watts",
+    ("urn:micasaverde-com:serviceId:EnergyMetering1", "KWH"): "kwh",
+    ("urn:micasaverde-com:serviceId:HaDevice1", "BatteryLevel"): "batterylevel",
+    ("urn:upnp-org:serviceId:TemperatureSensor1", "CurrentTemperature"): "temperature",
+    ("urn:upnp-org:serviceId:TemperatureSetpoint1_Heat", "CurrentSetpoint"): "heatsp",
+    ("urn:upnp-org:serviceId:TemperatureSetpoint1_Cool", "CurrentSetpoint"): "coolsp",
+    ("urn:upnp-org:serviceId:HVAC_UserOperatingMode1", "ModeStatus"): "mode",
+    ("urn:upnp-org:serviceId:HVAC_FanOperatingMode1", "Mode"): "fanmode",
+}
 kThermostatModes = {
     "Off": "Off",
     "Cool": "CoolOn",
@@ -88,7 +171,92 @@ kCommand_SetHeatSetpoint = "setHeatSetpoint"
 kCommand_SetCoolSetpoint = "setCoolSetpoint"
 kCommand_SetThermostatMode = "setThermostatMode"
 kCommand_SetThermostatFanMode = "setThermostatFanMode"
+kCommand_RefreshDevice = "refreshDevice"
+kCommand_ResetKwh = "resetKwh"
+# A command waiting to be sent is dropped when a newer one in the same group comes along for the same device, since
+# only the newest one matters (dragging a slider queues dozens of brightness changes). Commands that aren't in here
+# - scenes, locks and kWh resets - are always sent, in order.
+kCoalescedCommands = {
+    kCommand_TurnOn: "power",
+    kCommand_TurnOff: "power",
+    kCommand_SetBrightness: "level",
+    kCommand_SetHeatSetpoint: "heatSetpoint",
+    kCommand_SetCoolSetpoint: "coolSetpoint",
+    kCommand_SetThermostatMode: "mode",
+    kCommand_SetThermostatFanMode: "fanMode",
+    kCommand_RefreshDevice: "refresh",
+}
+# locks and scenes (which are often security related) go ahead of anything else that's waiting, and housekeeping
+# requests go last
+kCommandPriority_High = 0
+kCommandPriority_Normal = 1
+kCommandPriority_Low = 2
+kCommandPriorities = {
+    kCommand_Lock: kCommandPriority_High,
+    kCommand_Unlock: kCommandPriority_High,
+    kCommand_RunScene: kCommandPriority_High,
+    kCommand_RefreshDevice: kCommandPriority_Low,
+    kCommand_ResetKwh: kCommandPriority_Low,
+}
+# the Vera answers status requests from what it already knows without any Z-Wave traffic so they aren't paced
+kUnpacedCommands = (kCommand_RefreshDevice,)
+# commands that fail to get through are retried after kCommandRetryDelay seconds, doubling each time
+kCommandRetries = 3
+kCommandRetryDelay = 0.5
+# running a scene or resetting a meter twice isn't harmless, so these are only retried if the request never made it
+# to the Vera
+kNonRepeatableCommands = (kCommand_RunScene, kCommand_ResetKwh)
+# the lu_sdata field each command should change and the value it should end up with (None means the command's value)
+kCommandExpectations = {
+    kCommand_TurnOn: ("status", "1"),
+    kCommand_TurnOff: ("status", "0"),
+    kCommand_SetBrightness: ("level", None),
+    kCommand_Lock: ("locked", "1"),
+    kCommand_Unlock: ("locked", "0"),
+    kCommand_SetHeatSetpoint: ("heatsp", None),
+    kCommand_SetCoolSetpoint: ("coolsp", None),
+    kCommand_SetThermostatMode: ("mode", None),
+    kCommand_SetThermostatFanMode: ("fanmode", None),
+}
+# how long a command has to show up in the device's state before it's reported as unconfirmed - long enough for a
+# couple of regular polls when long polling isn't available
+kCommandConfirmTimeout = kPollInterval * 2 + kTimeout
 kErrorStates = ["2", "3"]
+kReadChunkSize = 16384
+kHttpState_Idle = "idle"
+kHttpState_Connecting = "connecting"
+kHttpState_Sending = "sending"
+kHttpState_Status = "status"
+kHttpState_Headers = "headers"
+kHttpState_Body = "body"
+kHttpState_ChunkSize = "chunkSize"
+kHttpState_ChunkData = "chunkData"
+kHttpState_ChunkEnd = "chunkEnd"
+kHttpState_ChunkTrailer = "chunkTrailer"
+# lu_sdata arrays whose records we decode one at a time, the other arrays in the response are skipped over
+kSdataRecordKeys = ("devices", "scenes")
+kParseState_Start = "start"
+kParseState_Key = "key"
+kParseState_Value = "value"
+kParseState_Skip = "skip"
+kParseState_Records = "records"
+kParseState_Record = "record"
+kParseState_Done = "done"
+kStructureRegex = re.compile(r'[\[\]{}"]')
+kStringRegex = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+kKeyRegex = re.compile(r'("[^"\\]*(?:\\.[^"\\]*)*")\s*:')
+kScalarRegex = re.compile(r'[^,}\]\s]+')
+kCategoryRegex = re.compile(r'"category"\s*:\s*(\d+)')
+
+
+def formatMessage(message, args):
+    # log messages carry their arguments separately so they're only formatted if someone reads them
+    if not args:
+        return message
+    try:
+        return message % args
+    except (TypeError, ValueError):
+        return "%s %r" % (message, args)
 
 
 def modelForDeviceInfo(deviceInfo):
@@ -99,206 +267,1818 @@ def modelForDeviceInfo(deviceInfo):
         return None
 
 
+################################################################################
+class VeraRecord(object):
+    # A device or scene from lu_sdata. Every field gets a slot so a Vera with a few hundred devices doesn't carry a dict
+    # per device. Fields the Vera hasn't sent yet are just missing, like they would be from the dict, and enough of the
+    # dict interface is here (get, [], in, keys, iteritems) for code written against the raw JSON to carry on working.
+    # Once a record is in a published VeraInventory it's never changed - updated() makes a new one instead.
+    __slots__ = ()
+    fieldSet = frozenset()
+
+    ########################################
+    def __init__(self, info):
+        self.update(info)
+
+    ########################################
+    def update(self, info):
+        # fields this kind of record doesn't keep are ignored
+        for key, value in info.iteritems():
+            if key in self.fieldSet:
+                setattr(self, key, value)
+
+    ########################################
+    def updated(self, info):
+        # returns a copy of the record with info folded in, or the record itself if info doesn't change anything
+        for key, value in info.iteritems():
+            if key in self.fieldSet and (key not in self or self[key] != value):
+                break
+        else:
+            return self
+        record = self.__class__(self.asDict())
+        record.update(info)
+        return record
+
+    ########################################
+    def get(self, key, default=None):
+        if key in self.fieldSet:
+            return getattr(self, key, default)
+        return default
+
+    ########################################
+    def __getitem__(self, key):
+        if key in self.fieldSet:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    ########################################
+    def __contains__(self, key):
+        return key in self.fieldSet and hasattr(self, key)
+
+    ########################################
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    ########################################
+    def iteritems(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key, getattr(self, key)
+
+    ########################################
+    def asDict(self):
+        return dict(self.iteritems())
+
+    ########################################
+    def memoryUsage(self):
+        # the record itself plus the values it points at - shared values like small ints get counted more than once
+        return sys.getsizeof(self) + sum(sys.getsizeof(value) for key, value in self.iteritems())
+
+    ########################################
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.asDict())
+
+
+################################################################################
+class VeraSceneRecord(VeraRecord):
+    __slots__ = kSceneFields
+    fieldSet = frozenset(kSceneFields)
+
+
+################################################################################
+class VeraDeviceRecord(VeraRecord):
+    # the generic record for categories without one of their own
+    __slots__ = kDeviceBaseFields + kDeviceSensorFields
+    fieldSet = frozenset(__slots__)
+
+
+########################################
+def _deviceRecordClass(category, typeInfo):
+    fields = kDeviceBaseFields + kDeviceCategoryFields.get(category, kDeviceSensorFields)
+    # veraDimmer becomes VeraDimmerRecord and so on
+    className = "%s%sRecord" % (typeInfo[0][0].upper(), typeInfo[0][1:])
+    return type(str(className), (VeraRecord,), {"__slots__": fields, "fieldSet": frozenset(fields)})
+
+
+# a record class for each category in kVeraDeviceTypeMap
+kDeviceRecordClasses = dict((category, _deviceRecordClass(category, typeInfo)) for category, typeInfo in kVeraDeviceTypeMap.iteritems() if typeInfo)
+
+
+########################################
+def deviceRecordForInfo(deviceInfo):
+    return kDeviceRecordClasses.get(deviceInfo.get("category", None), VeraDeviceRecord)(deviceInfo)
+
+
+################################################################################
+class VeraInventory(object):
+    # One version of a Vera's devices and scenes. The Vera thread never changes an inventory once it's published, it
+    # builds the next version (sharing every record that didn't change) and swaps it in with a single assignment. That
+    # lets the plugin's UI callbacks read vera.inventory without a lock and always see a consistent set of devices.
+    ########################################
+    def __init__(self, version=0, devices=None, scenes=None):
+        self.version = version
+        self.devices = devices if devices is not None else {}
+        self.scenes = scenes if scenes is not None else {}
+
+    ########################################
+    def changed(self, devices=None, scenes=None, deletedDevices=(), deletedScenes=()):
+        # Returns the next version with the records in devices and scenes added or replaced and the deleted ids
+        # removed, or this one if there's nothing to change.
+        devices = devices or {}
+        scenes = scenes or {}
+        if not devices and not scenes and not deletedDevices and not deletedScenes:
+            return self
+        inventory = VeraInventory(self.version + 1, dict(self.devices), dict(self.scenes))
+        for records, changedRecords, deletedIds in ((inventory.devices, devices, deletedDevices), (inventory.scenes, scenes, deletedScenes)):
+            records.update(changedRecords)
+            for recordId in deletedIds:
+                records.pop(recordId, None)
+        return inventory
+
+    ########################################
+    def memoryUsage(self):
+        # roughly how many bytes the devices and scenes take up
+        total = sys.getsizeof(self.devices) + sys.getsizeof(self.scenes)
+        for record in self.devices.itervalues():
+            total += record.memoryUsage()
+        for record in self.scenes.itervalues():
+            total += record.memoryUsage()
+        return total
+
+
+################################################################################
+def jobIdForActionResponse(body):
+    # lu_action answers with something like {"u:SetTargetResponse": {"JobID": "12"}}, scenes don't get a job
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return None
+    if isinstance(response, dict):
+        for value in response.itervalues():
+            if isinstance(value, dict) and "JobID" in value:
+                return value["JobID"]
+    return None
+
+
+################################################################################
+def stateValuesMatch(expectedValue, value):
+    # the Vera reports everything as strings and isn't consistent about "72" vs "72.0"
+    try:
+        return float(expectedValue) == float(value)
+    except (TypeError, ValueError):
+        return unicode(expectedValue) == unicode(value)
+
+
+################################################################################
+def sdataRecordFilter(key, text):
+    # drops device records for categories we don't support before they're decoded - incremental updates don't always
+    # include the category so those get through
+    if key == "devices":
+        match = kCategoryRegex.search(text)
+        if match and int(match.group(1)) not in kSupportedDeviceTypes:
+            return False
+    return True
+
+
+################################################################################
+class SdataParser(object):
+    # Parses an lu_sdata response incrementally as it comes off the socket instead of decoding the whole thing at
+    # once. Each record in the top level arrays named in recordKeys is decoded on its own and handed to
+    # recordCallback(key, record) as soon as it's complete. recordFilter(key, text) gets a look at the raw text of
+    # each record first and can return False to drop it without decoding it. Everything else that's an object or an
+    # array (rooms, sections, categories, ...) is skipped over without being decoded, and top level scalars (full,
+    # loadtime, dataversion, ...) end up in self.info.
+
+    def __init__(self, recordCallback, recordFilter=None, recordKeys=kSdataRecordKeys):
+        self.recordCallback = recordCallback
+        self.recordFilter = recordFilter
+        self.recordKeys = recordKeys
+        self.info = {}
+        self.buffer = ""
+        self.pos = 0
+        self.state = kParseState_Start
+        self.key = None
+        self.scanPos = 0
+        self.scanDepth = 0
+        self.byteCount = 0
+
+    ########################################
+    def feed(self, data):
+        self.byteCount += len(data)
+        # drop whatever has already been consumed so the buffer only ever holds the record that's being read
+        self.buffer = self.buffer[self.pos:] + data
+        self.scanPos -= self.pos
+        self.pos = 0
+        self._parse()
+
+    ########################################
+    def close(self):
+        if self.state != kParseState_Done:
+            raise ValueError("lu_sdata response ended early (%i bytes)" % self.byteCount)
+        return self.info
+
+    ########################################
+    def _skipWhitespace(self, separators=""):
+        buffer = self.buffer
+        pos = self.pos
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in separators):
+            pos += 1
+        self.pos = pos
+        return buffer[pos] if pos < len(buffer) else None
+
+    ########################################
+    def _startScan(self, state):
+        self.state = state
+        self.scanPos = self.pos
+        self.scanDepth = 0
+
+    ########################################
+    def _scan(self):
+        # Finds the end of the object or array that starts at self.pos and returns the index just past it, or -1 if
+        # it isn't all here yet. It picks up where the previous call left off so nothing gets scanned twice.
+        buffer = self.buffer
+        pos = self.scanPos
+        depth = self.scanDepth
+        while True:
+            match = kStructureRegex.search(buffer, pos)
+            if not match:
+                pos = len(buffer)
+                break
+            char = match.group()
+            if char == '"':
+                stringMatch = kStringRegex.match(buffer, match.start())
+                if not stringMatch:
+                    # the string isn't complete, start over on it when more data arrives
+                    pos = match.start()
+                    break
+                pos = stringMatch.end()
+                continue
+            pos = match.end()
+            if char in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+        self.scanPos = pos
+        self.scanDepth = depth
+        return -1
+
+    ########################################
+    def _parse(self):
+        while True:
+            if self.state == kParseState_Start:
+                char = self._skipWhitespace()
+                if char is None:
+                    return
+                if char != "{":
+                    raise ValueError("lu_sdata response isn't a JSON object")
+                self.pos += 1
+                self.state = kParseState_Key
+            elif self.state == kParseState_Key:
+                char = self._skipWhitespace(",")
+                if char is None:
+                    return
+                if char == "}":
+                    self.pos += 1
+                    self.state = kParseState_Done
+                    return
+                if char != '"':
+                    raise ValueError("unexpected data in lu_sdata response")
+                match = kKeyRegex.match(self.buffer, self.pos)
+                if not match:
+                    return
+                self.key = json.loads(match.group(1))
+                self.pos = match.end()
+                self.state = kParseState_Value
+            elif self.state == kParseState_Value:
+                char = self._skipWhitespace()
+                if char is None:
+                    return
+                if char == "[" and self.key in self.recordKeys:
+                    self.pos += 1
+                    self.state = kParseState_Records
+                elif char in "[{":
+                    self._startScan(kParseState_Skip)
+                else:
+                    match = (kStringRegex if char == '"' else kScalarRegex).match(self.buffer, self.pos)
+                    if not match or match.end() == len(self.buffer):
+                        # we can't tell whether the value is complete until we see what follows it
+                        return
+                    self.info[self.key] = json.loads(match.group())
+                    self.pos = match.end()
+                    self.state = kParseState_Key
+            elif self.state == kParseState_Skip:
+                end = self._scan()
+                if end < 0:
+                    # none of what's been scanned so far is needed
+                    self.pos = self.scanPos
+                    return
+                self.pos = end
+                self.state = kParseState_Key
+            elif self.state == kParseState_Records:
+                char = self._skipWhitespace(",")
+                if char is None:
+                    return
+                if char == "]":
+                    self.pos += 1
+                    self.state = kParseState_Key
+                else:
+                    self._startScan(kParseState_Record)
+            elif self.state == kParseState_Record:
+                end = self._scan()
+                if end < 0:
+                    return
+                text = self.buffer[self.pos:end]
+                self.pos = end
+                self.state = kParseState_Records
+                if self.recordFilter is None or self.recordFilter(self.key, text):
+                    self.recordCallback(self.key, json.loads(text))
+            else:
+                return
+
+
+################################################################################
+class RequestInterrupted(socket.error):
+    # the error a request ends with when VeraClient.interrupt() cuts it short
+    pass
+
+
+################################################################################
+class VeraRequest(object):
+    # A GET that's been handed to VeraClient. Once it's done, successfully or not, callback(request) is called on the
+    # client's thread with error set if it failed and otherwise body (unless a consumer was handed the body a chunk at
+    # a time as it arrived). A request that isn't repeatable is never sent a second time by the client itself.
+
+    def __init__(self, path, callback, timeouts, consumer, interruptible, repeatable=True):
+        self.path = path
+        self.callback = callback
+        self.connectTimeout, self.readTimeout = timeouts
+        self.consumer = consumer
+        self.interruptible = interruptible
+        self.repeatable = repeatable
+        self.status = None
+        self.reason = ""
+        self.chunks = []
+        self.body = None
+        self.error = None
+        self.deadline = 0
+        self.reused = False
+        self.retried = False
+        self.sent = False
+        self.responseStarted = False
+        self.startedAt = None
+        # everything the Vera sent back, kept only while traffic is being recorded
+        self.recordedChunks = None
+
+    ########################################
+    def handleData(self, data):
+        if self.recordedChunks is not None:
+            self.recordedChunks.append(data)
+        if self.consumer is not None and self.status == httplib.OK:
+            self.consumer(data)
+        else:
+            self.chunks.append(data)
+
+    ########################################
+    def complete(self, error):
+        self.error = error
+        if self.chunks:
+            self.body = "".join(self.chunks)
+            self.chunks = []
+        elif self.consumer is None:
+            self.body = ""
+        self.callback(self)
+
+
+################################################################################
+class VeraConnection(object):
+    # One non-blocking keep-alive connection to the Vera. It works through a single request at a time - connect if it
+    # isn't already, send the GET, then read the status line, the headers and a Content-Length, chunked or
+    # read-until-close body - whenever VeraClient's select loop says the socket is ready.
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.sock = None
+        self.request = None
+        self.state = kHttpState_Idle
+        self.outBuffer = ""
+        self.inBuffer = ""
+        self.headers = {}
+        self.remaining = None
+        self.keepAlive = True
+
+    ########################################
+    def fileno(self):
+        return self.sock.fileno()
+
+    ########################################
+    def start(self, request, now):
+        self.request = request
+        request.reused = self.sock is not None
+        self.outBuffer = (u"GET %s HTTP/1.1\r\nHost: %s:%i\r\nConnection: keep-alive\r\n\r\n" % (request.path, self.address, self.port)).encode("utf-8")
+        self.inBuffer = ""
+        self.keepAlive = True
+        if self.sock is None:
+            family, socketType, protocol, canonicalName, socketAddress = socket.getaddrinfo(self.address, self.port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socketType, protocol)
+            self.sock.setblocking(0)
+            error = self.sock.connect_ex(socketAddress)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(error, os.strerror(error))
+            self.state = kHttpState_Connecting
+            request.deadline = now + request.connectTimeout
+        else:
+            self.state = kHttpState_Sending
+            request.deadline = now + request.readTimeout
+
+    ########################################
+    def finish(self):
+        self.request = None
+        self.state = kHttpState_Idle
+        if not self.keepAlive:
+            self.close()
+
+    ########################################
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.request = None
+        self.state = kHttpState_Idle
+
+    ########################################
+    def wantsWrite(self):
+        return self.state in (kHttpState_Connecting, kHttpState_Sending)
+
+    ########################################
+    def handleWrite(self, now):
+        if self.state == kHttpState_Connecting:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self.state = kHttpState_Sending
+            self.request.deadline = now + self.request.readTimeout
+        sent = self.sock.send(self.outBuffer)
+        self.outBuffer = self.outBuffer[sent:]
+        if not self.outBuffer:
+            self.request.sent = True
+            self.state = kHttpState_Status
+        return False
+
+    ########################################
+    def handleRead(self, now):
+        # returns True once the whole response has arrived
+        try:
+            data = self.sock.recv(kReadChunkSize)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        if not data:
+            self.keepAlive = False
+            if self.state == kHttpState_Body and self.remaining is None:
+                return True
+            raise socket.error("the Vera closed the connection")
+        # like a socket timeout, the read timeout is how long we'll wait for the next bit of data
+        self.request.deadline = now + self.request.readTimeout
+        self.inBuffer += data
+        return self._processInput()
+
+    ########################################
+    def _processInput(self):
+        while True:
+            if self.state in (kHttpState_Body, kHttpState_ChunkData):
+                if self.remaining is None:
+                    data = self.inBuffer
+                else:
+                    data = self.inBuffer[:self.remaining]
+                    self.remaining -= len(data)
+                self.inBuffer = self.inBuffer[len(data):]
+                if data:
+                    self.request.handleData(data)
+                if self.remaining is None or self.remaining > 0:
+                    return False
+                if self.state == kHttpState_Body:
+                    return True
+                self.state = kHttpState_ChunkEnd
+            else:
+                end = self.inBuffer.find("\r\n")
+                if end < 0:
+                    return False
+                line = self.inBuffer[:end]
+                self.inBuffer = self.inBuffer[end + 2:]
+                if self._processLine(line):
+                    return True
+
+    ########################################
+    def _processLine(self, line):
+        # returns True if the line ends the response
+        if self.state == kHttpState_Status:
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+                raise httplib.BadStatusLine(line)
+            self.request.status = int(parts[1])
+            self.request.reason = parts[2] if len(parts) > 2 else ""
+            self.request.responseStarted = True
+            self.keepAlive = parts[0] == "HTTP/1.1"
+            self.headers = {}
+            self.state = kHttpState_Headers
+        elif self.state == kHttpState_Headers:
+            if line:
+                name, separator, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            elif self.request.status < 200:
+                # an informational response, the real one follows it
+                self.state = kHttpState_Status
+            else:
+                connection = self.headers.get("connection", "").lower()
+                if connection == "close":
+                    self.keepAlive = False
+                elif connection == "keep-alive":
+                    self.keepAlive = True
+                if "chunked" in self.headers.get("transfer-encoding", "").lower():
+                    self.state = kHttpState_ChunkSize
+                elif "content-length" in self.headers:
+                    self.remaining = int(self.headers["content-length"])
+                    self.state = kHttpState_Body
+                    return self.remaining == 0
+                else:
+                    # the body runs until the Vera closes the connection
+                    self.remaining = None
+                    self.keepAlive = False
+                    self.state = kHttpState_Body
+        elif self.state == kHttpState_ChunkSize:
+            size = int(line.split(";")[0].strip(), 16)
+            if size == 0:
+                self.state = kHttpState_ChunkTrailer
+            else:
+                self.remaining = size
+                self.state = kHttpState_ChunkData
+        elif self.state == kHttpState_ChunkEnd:
+            if line:
+                raise httplib.HTTPException("malformed chunked response")
+            self.state = kHttpState_ChunkSize
+        elif self.state == kHttpState_ChunkTrailer:
+            return not line
+        return False
+
+
+################################################################################
+class VeraClient(object):
+    # Non-blocking HTTP client core for a single Vera. Everything runs on the thread that calls runOnce() (for the Vera
+    # that's its own thread), so a long poll, several commands and status requests can all be in flight at the same
+    # time without a thread for each. Requests are started and their callbacks called from runOnce(), and wake() is
+    # the only method that's safe to call from other threads.
+
+    def __init__(self, address, port, maxConnections=kMaxConnections, maxIdle=kMaxIdleConnections):
+        self.address = address
+        self.port = port
+        self.maxConnections = maxConnections
+        self.maxIdle = maxIdle
+        self.idleConnections = []
+        self.activeConnections = []
+        # requests waiting for runOnce() to start them (or for a connection to free up)
+        self.waitingRequests = deque()
+        self.closed = False
+        # a VeraTrafficRecorder while traffic is being recorded
+        self.recorder = None
+        self.wakeReader, self.wakeWriter = socket.socketpair()
+        self.wakeReader.setblocking(0)
+        self.wakeWriter.setblocking(0)
+
+    ########################################
+    def wake(self):
+        # makes the select in runOnce() return right away
+        try:
+            self.wakeWriter.send("x")
+        except socket.error:
+            # either a wake up is already pending or we're closed
+            pass
+
+    ########################################
+    def request(self, path, callback, timeouts=kPollTimeouts, consumer=None, interruptible=False, repeatable=True):
+        if self.closed:
+            raise socket.error("the client for %s:%i is closed" % (self.address, self.port))
+        request = VeraRequest(path, callback, timeouts, consumer, interruptible, repeatable)
+        if self.recorder is not None:
+            request.recordedChunks = []
+        self.waitingRequests.append(request)
+        return request
+
+    ########################################
+    def interrupt(self):
+        # cuts short any interruptible request that's in flight (a long poll that would hold up something more urgent)
+        for connection in list(self.activeConnections):
+            if connection.request.interruptible:
+                self._finish(connection, RequestInterrupted("request interrupted: %s" % connection.request.path))
+
+    ########################################
+    def runOnce(self, timeout):
+        # Starts any waiting requests, waits up to timeout seconds for something to happen and deals with it.
+        self._dispatch()
+        now = time.time()
+        for connection in self.activeConnections:
+            timeout = min(timeout, connection.request.deadline - now)
+        idleConnections = list(self.idleConnections)
+        readers = [self.wakeReader] + idleConnections
+        writers = []
+        for connection in self.activeConnections:
+            if connection.wantsWrite():
+                writers.append(connection)
+            else:
+                readers.append(connection)
+        try:
+            readable, writable, exceptional = select.select(readers, writers, [], max(timeout, 0))
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        now = time.time()
+        handled = set()
+        for connection in writable:
+            handled.add(connection)
+            self._handle(connection, connection.handleWrite, now)
+        for connection in readable:
+            if connection is self.wakeReader:
+                self._drainWake()
+            elif connection in idleConnections:
+                # the Vera closed an idle connection (or sent something nobody asked for), either way it's done
+                if connection in self.idleConnections:
+                    self.idleConnections.remove(connection)
+                    connection.close()
+            elif connection not in handled and connection.request is not None:
+                handled.add(connection)
+                self._handle(connection, connection.handleRead, now)
+        for connection in list(self.activeConnections):
+            if connection.request.deadline <= now:
+                self._finish(connection, socket.timeout("timed out: %s" % connection.request.path))
+        self._dispatch()
+
+    ########################################
+    def close(self):
+        # drops everything without calling back - whoever was waiting on the requests is going away too
+        self.closed = True
+        for connection in self.activeConnections + self.idleConnections:
+            connection.close()
+        self.activeConnections = []
+        self.idleConnections = []
+        self.waitingRequests.clear()
+        self.wakeReader.close()
+        self.wakeWriter.close()
+
+    ########################################
+    def _drainWake(self):
+        try:
+            while self.wakeReader.recv(kReadChunkSize):
+                pass
+        except socket.error:
+            pass
+
+    ########################################
+    def _dispatch(self):
+        while self.waitingRequests and len(self.activeConnections) < self.maxConnections and not self.closed:
+            request = self.waitingRequests.popleft()
+            if request.startedAt is None:
+                request.startedAt = time.time()
+            if self.idleConnections and not request.retried:
+                connection = self.idleConnections.pop()
+            else:
+                connection = VeraConnection(self.address, self.port)
+            self.activeConnections.append(connection)
+            try:
+                connection.start(request, time.time())
+            except Exception, e:
+                self._finish(connection, e)
+
+    ########################################
+    def _handle(self, connection, method, now):
+        try:
+            if method(now):
+                self._finish(connection, None)
+        except Exception, e:
+            self._finish(connection, e)
+
+    ########################################
+    def _finish(self, connection, error):
+        request = connection.request
+        self.activeConnections.remove(connection)
+        if error is None:
+            connection.finish()
+            if connection.sock is not None and len(self.idleConnections) < self.maxIdle:
+                self.idleConnections.append(connection)
+            else:
+                connection.close()
+            if request.status != httplib.OK:
+                error = httplib.HTTPException("HTTP error %i: %s" % (request.status, request.reason))
+        else:
+            connection.close()
+            # The Vera closes idle connections on its end whenever it feels like it, so if a reused connection fails
+            # before any response came back we try once more on a fresh one. Unless it never got written out, a request
+            # that mustn't run twice is left for the caller to decide about since the Vera may have acted on it.
+            if request.reused and not request.retried and not request.responseStarted and (request.repeatable or not request.sent) and not isinstance(error, (socket.timeout, RequestInterrupted)):
+                request.retried = True
+                self.waitingRequests.appendleft(request)
+                return
+        if self.recorder is not None:
+            self.recorder.record(request, error, time.time())
+        request.complete(error)
+
+
+################################################################################
+class VeraTrafficRecorder(object):
+    # Writes every request VeraClient finishes to a gzipped log, one JSON object a line: a header and then each
+    # request with when it started, how long it took, and the status, error and body that came back. Bodies are kept
+    # as latin-1 so they come back byte for byte whatever the Vera sent. readTrafficLog() reads the log and
+    # VeraReplayClient plays it back.
+
+    def __init__(self, path, address, port, logMethod):
+        self.logMethod = logMethod
+        self.logFile = gzip.open(path, "wb")
+        self.startTime = time.time()
+        self.lastFlush = self.startTime
+        self._write({"type": "header", "version": kTrafficLogVersion, "address": address, "port": port, "startTime": self.startTime})
+
+    ########################################
+    def record(self, request, error, now):
+        if self.logFile is None:
+            return
+        startedAt = request.startedAt if request.startedAt is not None else now
+        self._write({
+            "type": "request",
+            "start": round(startedAt - self.startTime, 3),
+            "duration": round(now - startedAt, 3),
+            "path": request.path,
+            "status": request.status,
+            "error": str(error) if error is not None else None,
+            "errorType": error.__class__.__name__ if error is not None else None,
+            "body": "".join(request.recordedChunks or []).decode("latin-1"),
+        })
+        if now - self.lastFlush > kTrafficLogFlushInterval:
+            self.lastFlush = now
+            self._flush()
+
+    ########################################
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+
+    ########################################
+    def _write(self, entry):
+        try:
+            self.logFile.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        except Exception, e:
+            # a full disk shouldn't take the Vera down with it
+            self.logMethod("stopped recording traffic: %s", e, isError=True)
+            self.logFile = None
+
+    ########################################
+    def _flush(self):
+        try:
+            self.logFile.flush()
+        except Exception, e:
+            self.logMethod("stopped recording traffic: %s", e, isError=True)
+            self.logFile = None
+
+
+########################################
+def readTrafficLog(path):
+    # Returns the entries in a log written by VeraTrafficRecorder, header first, with the bodies back as the bytes the
+    # Vera sent. A log cut short by a crash is read up to where it ends.
+    entries = []
+    logFile = gzip.open(path, "rb")
+    try:
+        for line in logFile:
+            entry = json.loads(line)
+            if "body" in entry:
+                entry["body"] = entry["body"].encode("latin-1")
+            entries.append(entry)
+    except (IOError, EOFError, ValueError):
+        pass
+    finally:
+        logFile.close()
+    return entries
+
+
+# the errors a replayed request can fail with, by the name the recorder gave them - anything else is a socket.error
+kReplayErrors = {
+    "timeout": socket.timeout,
+    "RequestInterrupted": RequestInterrupted,
+    "HTTPException": httplib.HTTPException,
+    "BadStatusLine": httplib.BadStatusLine,
+}
+
+
+################################################################################
+class VeraReplayClient(object):
+    # Stands in for VeraClient and answers a Vera's requests from a traffic log instead of the network, either as
+    # fast as they're asked for or at the pace they were recorded. lu_sdata requests get the recorded ones in order
+    # whatever they ask for - the Vera asks for what the answers it's had so far tell it to - and anything else gets
+    # the recorded answer to the same path if there is one. finished is set once every recorded lu_sdata has been
+    # played, after which polls are left waiting like a long poll that never hears of a change.
+
+    def __init__(self, entries, realTime=False):
+        self.realTime = realTime
+        self.polls = deque()
+        self.otherRequests = {}
+        for entry in entries:
+            if entry.get("type", None) != "request":
+                continue
+            if "id=lu_sdata" in entry["path"]:
+                self.polls.append(entry)
+            else:
+                self.otherRequests.setdefault(entry["path"], deque()).append(entry)
+        self.waitingRequests = deque()
+        self.startTime = None
+        self.finished = not self.polls
+        self.closed = False
+        self.recorder = None
+        self.wakeEvent = threading.Event()
+
+    ########################################
+    def wake(self):
+        self.wakeEvent.set()
+
+    ########################################
+    def request(self, path, callback, timeouts=kPollTimeouts, consumer=None, interruptible=False, repeatable=True):
+        if self.closed:
+            raise socket.error("the replay client is closed")
+        request = VeraRequest(path, callback, timeouts, consumer, interruptible, repeatable)
+        self.waitingRequests.append(request)
+        return request
+
+    ########################################
+    def interrupt(self):
+        # the recorded answer stays put for the next request
+        for request in list(self.waitingRequests):
+            if request.interruptible:
+                self.waitingRequests.remove(request)
+                request.complete(RequestInterrupted("request interrupted: %s" % request.path))
+
+    ########################################
+    def runOnce(self, timeout):
+        now = time.time()
+        if self.startTime is None:
+            self.startTime = now
+        answered = False
+        for request in list(self.waitingRequests):
+            isPoll = "id=lu_sdata" in request.path
+            entries = self.polls if isPoll else self.otherRequests.get(request.path, None)
+            if isPoll and self.finished:
+                continue
+            if not entries:
+                self.waitingRequests.remove(request)
+                request.complete(socket.error("nothing left in the traffic log for %s" % request.path))
+                continue
+            entry = entries[0]
+            due = self.startTime + entry["start"] + entry["duration"] if self.realTime else now
+            if due > now:
+                timeout = min(timeout, due - now)
+                continue
+            entries.popleft()
+            self.waitingRequests.remove(request)
+            self._answer(request, entry)
+            answered = True
+            if not self.polls:
+                self.finished = True
+        if answered:
+            # the Vera will want to ask for the next one
+            return
+        self.wakeEvent.wait(max(timeout, 0))
+        self.wakeEvent.clear()
+
+    ########################################
+    def close(self):
+        self.closed = True
+        self.waitingRequests.clear()
+
+    ########################################
+    def _answer(self, request, entry):
+        request.startedAt = time.time()
+        request.status = entry["status"]
+        body = entry["body"]
+        for offset in range(0, len(body), kReadChunkSize):
+            request.handleData(body[offset:offset + kReadChunkSize])
+        error = None
+        if entry["error"] is not None:
+            error = kReplayErrors.get(entry["errorType"], socket.error)(entry["error"])
+        request.complete(error)
+
+
+################################################################################
+class VeraHistogram(object):
+    # Counts values into fixed buckets, so recording one is a bisect and an increment and the memory never grows.
+    # Percentiles come out as the upper bound of the bucket they fall in, which is plenty to tell a slow Vera from a
+    # healthy one.
+    __slots__ = ("bounds", "counts", "count", "total", "maximum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    ########################################
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    ########################################
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        else:
+            return 0
+        if index < len(self.bounds):
+            return min(self.bounds[index], self.maximum)
+        return self.maximum
+
+    ########################################
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0
+
+
+################################################################################
+class VeraMetrics(object):
+    # Counters, histograms and gauges for a vera thread (or the plugin). Only the owning thread records into them, and
+    # other threads only read, so there's no locking - a report can be a count or two behind. Gauges are methods that
+    # are only called when a report is made, so things like queue depths cost nothing until someone looks.
+
+    def __init__(self):
+        self.startedAt = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    ########################################
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    ########################################
+    def record(self, name, value, bounds=kMetricsTimeBuckets):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = self.histograms[name] = VeraHistogram(bounds)
+        histogram.record(value)
+
+    ########################################
+    def addGauge(self, name, method):
+        self.gauges[name] = method
+
+    ########################################
+    def values(self):
+        # every metric as a flat name -> number dict, histograms as their count, mean, 50th and 95th percentile and
+        # maximum
+        values = dict(self.counters.items())
+        for name, method in self.gauges.items():
+            try:
+                values[name] = method()
+            except Exception:
+                pass
+        for name, histogram in self.histograms.items():
+            values[name + "Count"] = histogram.count
+            values[name + "Mean"] = histogram.mean()
+            values[name + "P50"] = histogram.percentile(0.5)
+            values[name + "P95"] = histogram.percentile(0.95)
+            values[name + "Max"] = histogram.maximum
+        return values
+
+    ########################################
+    def report(self):
+        # a line for each metric, for the event log
+        lines = ["running for %i seconds" % (time.time() - self.startedAt)]
+        values = dict(self.counters.items())
+        for name, method in self.gauges.items():
+            try:
+                values[name] = method()
+            except Exception, e:
+                values[name] = "error: %s" % str(e)
+        for name in sorted(values):
+            lines.append("%s: %s" % (name, values[name]))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append("%s: %i recorded, mean %.2f, p50 %.2f, p95 %.2f, max %.2f" % (name, histogram.count, histogram.mean(), histogram.percentile(0.5), histogram.percentile(0.95), histogram.maximum))
+        return lines
+
+
+################################################################################
+class VeraFlightRecorder(object):
+    # The last kFlightRecorderSize log messages, debug ones included, kept unformatted in a ring so recording one is
+    # a deque append whether or not debugging is on. They only get formatted when the recorder is saved - on demand
+    # from the plugin's menu, or after an error so there's a record of what led up to it. Arguments are kept by
+    # reference, so a dict that changes later is saved as it is then.
+
+    def __init__(self, name, size=kFlightRecorderSize):
+        self.name = name
+        self.events = deque(maxlen=size)
+        self.lastSaved = 0
+
+    ########################################
+    def record(self, message, args=(), isError=False):
+        self.events.append((time.time(), isError, message, args))
+
+    ########################################
+    def saveAfterError(self, path):
+        # a burst of errors only saves the recorder once every kFlightRecorderSaveInterval seconds
+        if not path or time.time() - self.lastSaved < kFlightRecorderSaveInterval:
+            return
+        self.lastSaved = time.time()
+        saveFlightRecorders(path, [self])
+
+
+########################################
+def saveFlightRecorders(path, recorders):
+    # Writes the events of all the recorders to path as one timeline. Returns the number of events written.
+    events = []
+    for recorder in recorders:
+        # list() copies the deque in one go, so another thread recording at the same time can't break the iteration
+        events.extend((when, recorder.name, isError, message, args) for when, isError, message, args in list(recorder.events))
+    events.sort(key=itemgetter(0))
+    with open(path, "w") as recorderFile:
+        for when, name, isError, message, args in events:
+            prefix = u"%s.%03i %s: %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), int(when * 1000) % 1000, name, "ERROR " if isError else "")
+            text = formatMessage(message, args)
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            recorderFile.write(prefix.encode("utf-8") + text + "\n")
+    return len(events)
+
+
+################################################################################
+class VeraCommandQueue(Queue.Queue):
+    # the vera's command queue, which wakes up the vera's client whenever a command is put on it and timestamps the
+    # command
+
+    def __init__(self, wakeMethod):
+        Queue.Queue.__init__(self)
+        self.wakeMethod = wakeMethod
+
+    ########################################
+    def _put(self, item):
+        if item is not None:
+            # so the vera can report how long the command waited before it was sent
+            item["queuedAt"] = time.time()
+        Queue.Queue._put(self, item)
+        self.wakeMethod()
+
+
 ################################################################################
 class Vera(threading.Thread):
 
-    def __init__(self, address, port=3480, standardLogMethod=None, debugLogMethod=None):
+    def __init__(self, address, port=3480, standardLogMethod=None, debugLogMethod=None, longPoll=True, updateQueue=None, controllerId=None, commandPacing=kCommandPacing, maxCommandsInFlight=kMaxCommandsInFlight, snapshotPath=None, recordPath=None, client=None, flightRecorderPath=None):
         threading.Thread.__init__(self)
         self.address = address
         self.port = port
-        # temporarily set a very short timeout just to test to see if the vera is out there
-        socket.setdefaulttimeout(2)
-        # try to open the standard info url - it will throw if there's a problem and that's OK
-        theUrl = "http://%s:%i/%s" % (self.address, self.port, kPollingUrl)
-        f = urllib2.urlopen(theUrl)
-        f.close()
-        # set the timeout used for the rest of the execution of this thread
-        socket.setdefaulttimeout(kTimeout)
+        # every update this vera puts on the update queue is tagged with controllerId so several veras can share a queue
+        self.controllerId = controllerId if controllerId is not None else "%s:%i" % (address, port)
+        # all of the talking to the Vera happens on this thread through the client, the public methods below just
+        # set things up for it and wake it - nothing here touches the network so creating a Vera never blocks. A
+        # VeraReplayClient can be handed in to play back recorded traffic instead.
+        self.client = client if client is not None else VeraClient(address, port)
+        # every request and response gets written here while the thread runs, see VeraTrafficRecorder
+        self.recordPath = recordPath
         self.standardLogMethod = standardLogMethod
         self.debugLogMethod = debugLogMethod
+        # everything logged, debug or not, is kept here and saved to flightRecorderPath after an error
+        self.flightRecorder = VeraFlightRecorder("vera %s:%i" % (address, port))
+        self.flightRecorderPath = flightRecorderPath
         self.state = -1
         self.version = ""
         self.model = ""
         self.serial = ""
         self.lastLoadTime = 0
         self.lastDataVersion = 0
-        self.scenes = {}
-        self.devices = {}
+        # only ever replaced as a whole, see VeraInventory
+        self.inventory = VeraInventory()
         self.lastPoll = 0
-        self.updateQueue = Queue.Queue()
+        self.updateQueue = updateQueue if updateQueue is not None else Queue.Queue()
         self.shouldContinue = True
-        self.commandQueue = None
+        self.commandQueue = VeraCommandQueue(self.client.wake)
+        # commands taken off the queue that are waiting for an earlier command to the same device or scene to finish
+        self.pendingCommands = []
+        self.busyTargets = set()
+        self.commandPacing = commandPacing
+        self.maxCommandsInFlight = maxCommandsInFlight
+        self.lastCommandSent = 0
+        # what the commands we've sent should change, keyed by (device id, lu_sdata field)
+        self.expectations = {}
+        self.pollRequest = None
         self.fullUpdateNow = True
+        self.resendAllNow = False
+        self.fullUpdateAt = 0
         self.lastFullUpdate = 0
         self.threadDebug = False
+        self.longPoll = longPoll
+        self.longPollFailures = 0
+        self.lastPollSucceeded = False
+        self.pollFailures = 0
+        self.retryDelay = 0
+        # reported to the plugin with a connectionState update whenever it changes
+        self.connectionState = kConnectionState_Connecting
+        self.snapshotPath = snapshotPath
+        self.lastSnapshot = 0
+        # read by the plugin for its metrics menu item and variables, see VeraMetrics
+        self.metrics = VeraMetrics()
+        self.metrics.addGauge("connectionState", lambda: self.connectionState)
+        self.metrics.addGauge("commandQueueDepth", lambda: self.commandQueue.qsize() + len(self.pendingCommands))
+        self.metrics.addGauge("commandsInFlight", lambda: len(self.busyTargets))
+        self.metrics.addGauge("commandsAwaitingConfirmation", lambda: len(self.expectations))
+        self.metrics.addGauge("devices", lambda: len(self.devices))
+        self.metrics.addGauge("inventoryVersion", lambda: self.inventory.version)
+        self._loadSnapshot()
 
     ########################################
-    def logMethod(self, output, isError=False, isDebug=True):
-        if isError:
-            isDebug = False
+    def logMethod(self, output, *args, **kwargs):
+        # output is a format string for args, and it's only formatted if the message is going to be logged - a debug
+        # message while threadDebug is off costs a flight recorder append
+        isError = kwargs.get("isError", False)
+        isDebug = kwargs.get("isDebug", True) and not isError
+        self.flightRecorder.record(output, args, isError)
         if isDebug:
             if self.threadDebug:
                 if self.debugLogMethod:
-                    self.debugLogMethod("vera thread: %s" % output)
+                    self.debugLogMethod("vera thread (%s): %s" % (self.address, formatMessage(output, args)))
                 else:
-                    print output
+                    print formatMessage(output, args)
         elif self.standardLogMethod:
-            self.standardLogMethod("vera thread: %s" % output, isError=isError)
+            self.standardLogMethod("vera thread (%s): %s" % (self.address, formatMessage(output, args)), isError=isError)
         else:
-            print "vera thread: %s" % output
+            print "vera thread (%s): %s" % (self.address, formatMessage(output, args))
+        if isError:
+            try:
+                self.flightRecorder.saveAfterError(self.flightRecorderPath)
+            except Exception, e:
+                self.flightRecorderPath = None
+                self.logMethod("can't save the flight recorder, not trying again: %s", e, isDebug=False)
 
     ########################################
     def stop(self):
         self.shouldContinue = False
+        if self.ident is None:
+            # the thread never ran so there's nobody to close the client
+            self.client.close()
+        else:
+            self.client.wake()
 
     ########################################
-    def doFullUpdate(self):
+    def refreshDevice(self, deviceId):
+        # Asks the Vera for the current state of just this device. The request goes out with the commands so the
+        # caller doesn't wait on it, and it leaves the lu_sdata loadtime/dataversion alone so polling carries on
+        # incrementally.
+        self.commandQueue.put_nowait({"id": deviceId, "command": kCommand_RefreshDevice})
+
+    ########################################
+    def doFullUpdate(self, resendAll=False):
+        # full updates normally only report devices that changed - resendAll sends every device's state along
+        if resendAll:
+            self.resendAllNow = True
         self.fullUpdateNow = True
+        self.client.wake()
+
+    ########################################
+    def scheduleFullUpdate(self, resendAll=False, delay=kFullUpdateDebounce):
+        # Coalesces a burst of requests into a single full update once they've stopped coming in for delay seconds.
+        if resendAll:
+            self.resendAllNow = True
+        self.fullUpdateAt = time.time() + delay
+        self.client.wake()
+
+    ########################################
+    def resendDevice(self, deviceId):
+        # Queues the whole last known state of a device without asking the Vera for it. Returns False if we don't
+        # know about the device, in which case a full update will have to find it.
+        deviceInfo = self.devices.get(deviceId, None)
+        if deviceInfo is None:
+            return False
+        self._queueUpdate({"updateType": "updateDevice", "device": deviceInfo.asDict()})
+        return True
+
+    ########################################
+    @property
+    def devices(self):
+        return self.inventory.devices
+
+    ########################################
+    @property
+    def scenes(self):
+        return self.inventory.scenes
 
     ########################################
     def setThreadDebug(self, debug):
         self.threadDebug = debug
 
+    ########################################
+    def _queueUpdate(self, updateDict):
+        updateDict["controller"] = self.controllerId
+        self.updateQueue.put_nowait(updateDict)
+
     ########################################
     def run(self):
-        self.logMethod("starting run loop: debugging: %s" % ("True" if self.threadDebug else "False"))
+        self.logMethod("starting run loop: debugging: %s", "True" if self.threadDebug else "False")
         try:
+            if self.recordPath:
+                try:
+                    self.client.recorder = VeraTrafficRecorder(self.recordPath, self.address, self.port, self.logMethod)
+                    self.logMethod("recording traffic to %s", self.recordPath, isDebug=False)
+                except Exception, e:
+                    self.logMethod("can't record traffic: %s", e, isError=True)
             while self.shouldContinue:
-                queueHasItems = True
-                while self.commandQueue and self.shouldContinue and queueHasItems and not self.fullUpdateNow:
-                    try:
-                        commandDict = self.commandQueue.get_nowait()
-                        self.logMethod("processing command: %s" % str(commandDict))
-                        self._processCommand(commandDict)
-                        self.commandQueue.task_done()
-                    except:
-                        queueHasItems = False
-                if ((int(time.time()) - self.lastPoll) >= kPollInterval) or self.fullUpdateNow:
-                    self._update(fullUpdate=self.fullUpdateNow)
-                    self.lastPoll = int(time.time())
-                time.sleep(.1)
+                waits = [self._dispatchCommands(), self._pollIfDue(), self._expireExpectations()]
+                # the client returns as soon as a request needs looking after, and doFullUpdate(),
+                # scheduleFullUpdate(), stop() and new commands wake it up early
+                self.client.runOnce(min(wait for wait in waits if wait is not None))
         except Exception, e:
-            self.logMethod("some exception in the run loop occurred:\n%s" % str(e))
+            self.logMethod("some exception in the run loop occurred:\n%s", e)
+        finally:
+            self.client.close()
+            if self.client.recorder is not None:
+                self.client.recorder.close()
+            self._saveSnapshot()
         self.logMethod("exiting run loop")
 
     ########################################
-    def _update(self,  updateDevAddress=0, fullUpdate=False):
-        self.logMethod("_update: starting at %s" % datetime.today().strftime("%H:%M:%S"), isError=False)
+    def _loadSnapshot(self):
+        # Picks up the device and scene inventory saved by the last run so it's there right away and polling carries on
+        # incrementally from where it left off (the Vera sends everything anyway if it has restarted since). Anything
+        # wrong with the snapshot just means starting with a full update like before.
+        if not self.snapshotPath or not os.path.exists(self.snapshotPath):
+            return
+        try:
+            with open(self.snapshotPath, "rb") as snapshotFile:
+                snapshot = json.loads(zlib.decompress(snapshotFile.read()))
+            if snapshot["version"] != kSnapshotVersion or snapshot["address"] != self.address or snapshot["port"] != self.port:
+                self.logMethod("ignoring snapshot for a different Vera")
+                return
+            devices = dict((deviceInfo["id"], deviceRecordForInfo(deviceInfo)) for deviceInfo in snapshot["devices"])
+            scenes = dict((sceneInfo["id"], VeraSceneRecord(sceneInfo)) for sceneInfo in snapshot["scenes"])
+            self.inventory = VeraInventory().changed(devices, scenes)
+            self.lastLoadTime = snapshot["loadtime"]
+            self.lastDataVersion = snapshot["dataversion"]
+            self.lastFullUpdate = snapshot["lastFullUpdate"]
+            self.fullUpdateNow = False
+            self.logMethod("loaded snapshot with %i scenes and %i devices", len(self.scenes), len(self.devices))
+        except Exception, e:
+            self.logMethod("ignoring snapshot that can't be read: %s", e)
+
+    ########################################
+    def _saveSnapshot(self):
+        # written to a temporary file first so a crash part way through can't leave a truncated snapshot
+        if not self.snapshotPath or not self.lastFullUpdate or not self.lastLoadTime:
+            return
+        snapshot = {
+            "version": kSnapshotVersion,
+            "address": self.address,
+            "port": self.port,
+            "loadtime": self.lastLoadTime,
+            "dataversion": self.lastDataVersion,
+            "lastFullUpdate": self.lastFullUpdate,
+            "devices": [deviceInfo.asDict() for deviceInfo in self.devices.itervalues()],
+            "scenes": [sceneInfo.asDict() for sceneInfo in self.scenes.itervalues()],
+        }
+        try:
+            data = zlib.compress(json.dumps(snapshot, separators=(",", ":")))
+            temporaryPath = self.snapshotPath + ".tmp"
+            with open(temporaryPath, "wb") as snapshotFile:
+                snapshotFile.write(data)
+            os.rename(temporaryPath, self.snapshotPath)
+            self.lastSnapshot = time.time()
+            self.logMethod("saved snapshot (%i bytes)", len(data))
+        except Exception, e:
+            self.logMethod("can't save snapshot: %s", e, isError=True)
 
-        if (fullUpdate or int(updateDevAddress) > 0):
+    ########################################
+    def _pollIfDue(self):
+        # Starts the next poll if it's time and returns how long the run loop can wait before it needs to look again.
+        now = time.time()
+        if self.fullUpdateAt and self.fullUpdateAt <= now:
+            self.fullUpdateAt = 0
+            self.fullUpdateNow = True
+        if self.pollRequest is not None:
+            if self.fullUpdateNow or self.fullUpdateAt:
+                # don't let a long poll hold up a full update
+                self.client.interrupt()
+            if self.pollRequest is not None:
+                return kPollInterval
+        if not self.lastPollSucceeded:
+            nextPoll = self.lastPoll + self.retryDelay
+        elif self.fullUpdateNow or (self.longPoll and self.lastLoadTime):
+            # the Vera blocks long polls until something changes so there's no need to wait between them
+            nextPoll = now
+        else:
+            nextPoll = self.lastPoll + kPollInterval
+        if self.fullUpdateAt:
+            # a scheduled full update takes the place of the next poll - we don't want to start a long poll that would
+            # hold it up, but we still wait out the retry interval after a failure
+            if self.lastPollSucceeded:
+                nextPoll = self.fullUpdateAt
+            else:
+                nextPoll = max(nextPoll, self.fullUpdateAt)
+        if nextPoll > now:
+            return nextPoll - now
+        if self.fullUpdateNow:
+            self._update(fullUpdate=True)
+        elif self.longPoll and self.lastLoadTime and self.connectionState == kConnectionState_Connected:
+            self._update(longPoll=True)
+        else:
+            # a long poll doesn't answer until something changes, so until a poll has gone through it wouldn't tell
+            # us whether the Vera is back
+            self._update()
+        return kPollInterval
+
+    ########################################
+    def _update(self, fullUpdate=False, longPoll=False):
+        self.logMethod("_update: starting at %s", datetime.today().strftime("%H:%M:%S"), isError=False)
+
+        if fullUpdate:
             self.lastLoadTime = 0
             self.lastDataVersion = 0
-        theUrl = "http://%s:%i/%s&loadtime=%i&dataversion=%i" % (self.address, self.port, kPollingUrl, self.lastLoadTime, self.lastDataVersion)
-        self.logMethod("_update: url: %s" % theUrl, isError=False)
-        self.logMethod("_update: devAddress %s" % updateDevAddress, isError=False)
+            longPoll = False
+        theUrl = "%s&loadtime=%i&dataversion=%i" % (kPollingUrl, self.lastLoadTime, self.lastDataVersion)
+        timeouts = kPollTimeouts
+        if longPoll:
+            theUrl += "&timeout=%i&minimumdelay=%i" % (kLongPollTimeout, kLongPollMinimumDelay)
+            timeouts = kLongPollTimeouts
+        self.logMethod("_update: url: %s", theUrl, isError=False)
 
-        try:
-            f = urllib2.urlopen(theUrl)
-            infoDict = json.load(f)
-            f.close()
-            # self.logMethod("_update: dict: %s" % infoDict, isError=True)
+        # Scene and device records are handled one at a time as the parser pulls them out of the response. Devices that
+        # changed since we last saw them go onto the update queue right away (all of them if a resend of everything
+        # was asked for), and the rest of our bookkeeping waits until the whole response has arrived.
+        resendAll = fullUpdate and self.resendAllNow
+        newSceneDict = {}
+        newDeviceDict = {}
 
-            if int(updateDevAddress) > 0:
-                # Just update a single device
+        def handleRecord(key, record):
+            if key == "scenes":
+                newSceneDict[record["id"]] = record
+                return
+            if not parser.info.get("full", True) and record["id"] not in self.devices:
+                # Only a full update adds devices to the inventory, so on a partial one (the Vera says which before the
+                # devices) a device that isn't there - an unsupported type, say - would otherwise be sent along whole
+                # with every poll.
+                return
+            changedInfo = record if resendAll else self._changedDeviceInfo(record)
+            if changedInfo:
+                self.logMethod("_update: adding update to update queue: %s", changedInfo)
+                self._queueUpdate({"updateType": "updateDevice", "device": changedInfo})
+                self._checkExpectations(changedInfo)
+            newDeviceDict[record["id"]] = record
 
-                newDeviceDict = {}
-                for deviceInfo in infoDict.get("devices", []):
-                    if int(deviceInfo["id"]) == int(updateDevAddress):
-                        self.logMethod("_update: partial deviceInfo:\n%s" % str(deviceInfo), isError=False)
-                        self.updateQueue.put_nowait({"updateType": "updateDevice", "device": deviceInfo})
+        def handleResponse(request):
+            self.pollRequest = None
+            self.lastPollSucceeded = self._finishUpdate(request, parser, startTime, longPoll, resendAll, newSceneDict, newDeviceDict)
+            self.lastPoll = time.time()
+            self._recordPoll(fullUpdate, longPoll, request, self.lastPollSucceeded, self.lastPoll - startTime, parser.byteCount, len(newDeviceDict))
+            self._pollFinished(self.lastPollSucceeded)
 
-            elif infoDict["full"]:
-                if self.threadDebug:
-                    s = json.dumps(infoDict, sort_keys=True, indent=4)
-                    self.logMethod("_update: doing full update with infoDict:\n\n%s\n\n" % s)
-                # First we'll get the scenes
-                newSceneDict = {}
-                for sceneInfo in infoDict.get("scenes", []):
-                    self.logMethod("sceneInfo: %s" % sceneInfo)
-                    newSceneDict[sceneInfo["id"]] = sceneInfo
-                self.scenes = newSceneDict
-                self.logMethod("_update: scenes:\n%s" % str(self.scenes))
-                # Next we'll do the devices
-                newDeviceDict = {}
-                oldDeviceDict = copy.copy(self.devices)
-                for deviceInfo in infoDict.get("devices", []):
-                    deviceType = deviceInfo["category"]
-                    if deviceType in kSupportedDeviceTypes:
-                        deviceId = deviceInfo["id"]
-                        if deviceId in oldDeviceDict:
-                            del oldDeviceDict[deviceId]
-                        self.logMethod("_update: adding update to update queue: %s" % (deviceInfo))
-                        self.updateQueue.put_nowait({"updateType": "updateDevice", "device": deviceInfo})
-                        newDeviceDict[deviceId] = deviceInfo
-                for device in oldDeviceDict:
-                    self.logMethod("adding delete to update queue: %s" % (device))
-                    self.updateQueue.put_nowait({"updateType": "deleteDevice", "device": device})
-                    pass
-                self.devices = newDeviceDict
-                self.logMethod("_update: devices:\n%s" % str(self.devices))
+        startTime = time.time()
+        parser = SdataParser(handleRecord, sdataRecordFilter)
+        self.pollRequest = self.client.request(theUrl, handleResponse, timeouts=timeouts, consumer=parser.feed, interruptible=longPoll)
+
+    ########################################
+    def _recordPoll(self, fullUpdate, longPoll, request, succeeded, elapsed, byteCount, deviceCount):
+        if not succeeded:
+            self.metrics.count("pollFailures")
+            return
+        if isinstance(request.error, RequestInterrupted):
+            self.metrics.count("longPollsInterrupted")
+            return
+        # a long poll's time is mostly the Vera waiting for something to change, so it's kept apart from the others
+        if fullUpdate:
+            kind = "fullUpdate"
+        elif longPoll:
+            kind = "longPoll"
+        else:
+            kind = "poll"
+        self.metrics.count(kind + "s")
+        self.metrics.record(kind + "Time", elapsed * 1000)
+        self.metrics.record(kind + "Bytes", byteCount, kMetricsSizeBuckets)
+        self.metrics.record("devicesPerUpdate", deviceCount, kMetricsCountBuckets)
+        self.metrics.count("bytesReceived", byteCount)
+
+    ########################################
+    def _pollFinished(self, succeeded):
+        if succeeded:
+            self.pollFailures = 0
+            self._setConnectionState(kConnectionState_Connected)
+            return
+        self.pollFailures += 1
+        # the jitter keeps several Veras (or several plugins) that lost the network at the same time from all retrying
+        # in lockstep once it's back
+        delay = min(kMaxRetryInterval, kRetryInterval * 2 ** (self.pollFailures - 1))
+        self.retryDelay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        if self.pollFailures >= kDownFailureCount:
+            self._setConnectionState(kConnectionState_Down)
+        elif self.connectionState == kConnectionState_Connected:
+            self._setConnectionState(kConnectionState_Degraded)
+
+    ########################################
+    def _setConnectionState(self, state):
+        if state != self.connectionState:
+            self.logMethod("connection state changed from %s to %s", self.connectionState, state)
+            self._queueUpdate({"updateType": "connectionState", "state": state, "previousState": self.connectionState})
+            self.connectionState = state
+
+    ########################################
+    def _finishUpdate(self, request, parser, startTime, longPoll, resendAll, newSceneDict, newDeviceDict):
+        try:
+            if request.error is not None:
+                raise request.error
+            infoDict = parser.close()
+            if longPoll:
+                self._checkLongPollSupport(time.time() - startTime, infoDict)
+
+            # only the records that changed are replaced in the next inventory, the rest are shared with this one
+            scenes = {}
+            devices = {}
+            if infoDict["full"]:
+                self.logMethod("_update: full update with %i scenes and %i supported devices (%i bytes)", len(newSceneDict), len(newDeviceDict), parser.byteCount)
+                for sceneId, sceneInfo in newSceneDict.iteritems():
+                    record = self._updatedRecord(self.scenes.get(sceneId, None), sceneInfo, VeraSceneRecord)
+                    if record is not self.scenes.get(sceneId, None):
+                        scenes[sceneId] = record
+                if resendAll:
+                    self.resendAllNow = False
+                for device in self.devices:
+                    if device not in newDeviceDict:
+                        self.logMethod("adding delete to update queue: %s", device)
+                        self._queueUpdate({"updateType": "deleteDevice", "device": device})
+                for deviceId, deviceInfo in newDeviceDict.iteritems():
+                    record = self._updatedRecord(self.devices.get(deviceId, None), deviceInfo, deviceRecordForInfo)
+                    if record is not self.devices.get(deviceId, None):
+                        devices[deviceId] = record
+                self.inventory = self.inventory.changed(devices, scenes,
+                                                        [deviceId for deviceId in self.devices if deviceId not in newDeviceDict],
+                                                        [sceneId for sceneId in self.scenes if sceneId not in newSceneDict])
                 self.fullUpdateNow = False
                 self.lastFullUpdate = int(time.time())
+                # adding up the inventory's size walks every record, so it's only done when someone will see it
+                if self.threadDebug:
+                    self.logMethod("_update: inventory uses about %i bytes", self.inventory.memoryUsage())
 
             else:
                 # Not a full update - so we don't check and notify for deletions, etc.
-                for sceneInfo in infoDict.get("scenes", []):
+                self.logMethod("_update: partial update with %i scenes and %i devices (%i bytes)", len(newSceneDict), len(newDeviceDict), parser.byteCount)
+                for sceneInfo in newSceneDict.itervalues():
                     if sceneInfo["active"]:
-                        self.scenes[sceneInfo["id"]] = sceneInfo
+                        record = self._updatedRecord(self.scenes.get(sceneInfo["id"], None), sceneInfo, VeraSceneRecord)
+                        if record is not self.scenes.get(sceneInfo["id"], None):
+                            scenes[sceneInfo["id"]] = record
 
-                for deviceInfo in infoDict.get("devices", []):
-                    self.logMethod("_update: partial deviceInfo:\n%s" % str(deviceInfo), isError=False)
-                    self.updateQueue.put_nowait({"updateType": "updateDevice", "device": deviceInfo})
+                for deviceInfo in newDeviceDict.itervalues():
+                    record = self._mergedDeviceRecord(deviceInfo)
+                    if record is not None:
+                        devices[deviceInfo["id"]] = record
+                self.inventory = self.inventory.changed(devices, scenes)
 
                 # if we're over 30 minutes from the last full update, do it now
                 if (int(time.time()) - kFullUpdateInterval) > self.lastFullUpdate:
                     self.fullUpdateNow = True
 
+            self.logMethod("_update: inventory version %i, %i records replaced, %i unchanged", self.inventory.version, len(scenes) + len(devices), len(newSceneDict) + len(newDeviceDict) - len(scenes) - len(devices))
             self.lastLoadTime = infoDict.get("loadtime", 0)
             self.lastDataVersion = infoDict.get("dataversion", 0)
-        except urllib2.URLError, e:
-            self.logMethod("_update: url open error:\n%s" % traceback.format_exc(10))
+            if infoDict["full"] or time.time() - self.lastSnapshot > kSnapshotInterval:
+                self._saveSnapshot()
+            return True
+        except RequestInterrupted, e:
+            # something more urgent needs the poll, nothing actually went wrong
+            self.logMethod("_update: long poll interrupted")
+            return True
+        except socket.timeout, e:
+            self.logMethod("_update: timed out waiting for the Vera")
+        except socket.error, e:
+            self.logMethod("_update: url open error: %s", e)
         except httplib.BadStatusLine, e:
             self.logMethod("The Vera isn't responding correctly. Make sure it's available. If it's performing a software upgrade, wait until it's finished then restart the plugin.")
         except KeyError, e:
-            self.logMethod("_update: key error:\n%s" % traceback.format_exc(10))
+            self.logMethod("_update: key error:\n%s", traceback.format_exc(10))
         except Exception, e:
-            self.logMethod("_update: vera update error: %s" % traceback.format_exc(10), isError=True)
+            self.logMethod("_update: vera update error: %s", traceback.format_exc(10), isError=True)
         finally:
-            self.logMethod("_update: ending at %s" % datetime.today().strftime("%H:%M:%S"))
+            self.logMethod("_update: ending at %s", datetime.today().strftime("%H:%M:%S"))
+        return False
+
+    ########################################
+    def _refreshDevice(self, commandDict):
+        deviceId = commandDict["id"]
+        theUrl = kStatusUrl % deviceId
+        self.logMethod("_refreshDevice: url: %s", theUrl)
+
+        def handleResponse(request):
+            try:
+                if request.error is not None:
+                    raise request.error
+                statusDict = json.loads(request.body)
+                deviceInfo = {"id": deviceId}
+                for stateInfo in statusDict.get("Device_Num_%i" % deviceId, {}).get("states", []):
+                    key = kStatusVariableMap.get((stateInfo.get("service", None), stateInfo.get("variable", None)), None)
+                    if key:
+                        deviceInfo[key] = stateInfo.get("value", None)
+                self.logMethod("_refreshDevice: deviceInfo: %s", deviceInfo)
+                changedInfo = self._changedDeviceInfo(deviceInfo)
+                if changedInfo:
+                    self._queueUpdate({"updateType": "updateDevice", "device": changedInfo})
+                    self._checkExpectations(changedInfo)
+                record = self._mergedDeviceRecord(deviceInfo)
+                if record is not None:
+                    self.inventory = self.inventory.changed({deviceId: record})
+            except Exception, e:
+                self.logMethod(u"refresh device error: %s", e, isError=True)
+
+        self._sendCommandRequest(commandDict, theUrl, handleResponse)
+
+    ########################################
+    def _changedDeviceInfo(self, deviceInfo):
+        # Returns only the fields of deviceInfo that differ from the last ones we saw for the device (plus its id so
+        # the plugin knows which device it is), or an empty dict if nothing changed. Devices we haven't seen before
+        # are returned whole.
+        deviceId = deviceInfo["id"]
+        lastInfo = self.devices.get(deviceId, None)
+        if lastInfo is None:
+            return deviceInfo
+        changedInfo = {}
+        for key, value in deviceInfo.iteritems():
+            # fields the record doesn't keep would otherwise look changed every time
+            if key in lastInfo.fieldSet and (key not in lastInfo or lastInfo[key] != value):
+                changedInfo[key] = value
+        if changedInfo:
+            changedInfo["id"] = deviceId
+        return changedInfo
+
+    ########################################
+    def _mergedDeviceRecord(self, deviceInfo):
+        # Partial updates only carry some of a device's fields so fold them into what we already know about it. Returns
+        # the device's new record, or None if we don't know the device or nothing changed.
+        record = self.devices.get(deviceInfo["id"], None)
+        if record is None:
+            return None
+        mergedRecord = self._updatedRecord(record, deviceInfo, deviceRecordForInfo)
+        return mergedRecord if mergedRecord is not record else None
+
+    ########################################
+    def _updatedRecord(self, record, info, recordFactory):
+        # Returns the record for info - the existing one if info doesn't change it. A device that changed category
+        # needs a record with a different set of fields.
+        if record is None or ("category" in info and record.get("category", None) != info["category"]):
+            return recordFactory(info)
+        return record.updated(info)
+
+    ########################################
+    def _checkLongPollSupport(self, elapsed, infoDict):
+        # Firmware that doesn't understand timeout/minimumdelay answers right away even when nothing has changed,
+        # where one that does only answers with nothing new once the timeout runs out. The minimum delay is too short
+        # to tell them apart by (a slow Vera can take longer than that to answer any poll), so anything well short of
+        # the timeout counts. If that keeps happening we fall back to polling every kPollInterval seconds.
+        if elapsed < kLongPollEarlyAnswer and infoDict.get("dataversion", 0) == self.lastDataVersion:
+            self.longPollFailures += 1
+            if self.longPollFailures >= kLongPollFailureLimit:
+                self.longPoll = False
+                self.logMethod("the Vera doesn't appear to support long polling, falling back to polling every %i seconds", kPollInterval, isDebug=False)
+        else:
+            self.longPollFailures = 0
 
     ########################################
     def _kwhReset(self,  resetDevAddress):
-        self.logMethod("_reset: starting at %s" % datetime.today().strftime("%H:%M:%S"), isError=False)
+        # the reset goes out with the commands so the caller doesn't wait on it
+        self.commandQueue.put_nowait({"id": int(resetDevAddress), "command": kCommand_ResetKwh})
 
-        theUrl = "http://%s:%i/%s&DeviceNum=%s&serviceId=urn:micasaverde-com:serviceId:EnergyMetering1&action=ResetKWH" % (self.address, self.port, kResetKwhUrl, resetDevAddress)
-        self.logMethod("_reset: url: %s" % theUrl, isError=False)
-        self.logMethod("_reset: devAddress %s" % resetDevAddress, isError=False)
+    ########################################
+    def _resetKwh(self, commandDict):
+        self.logMethod("_reset: starting at %s", datetime.today().strftime("%H:%M:%S"), isError=False)
 
-        try:
-            f = urllib2.urlopen(theUrl)
-            f.close()
+        resetDevAddress = commandDict["id"]
+        theUrl = "%s&DeviceNum=%s&serviceId=urn:micasaverde-com:serviceId:EnergyMetering1&action=ResetKWH" % (kResetKwhUrl, resetDevAddress)
+        self.logMethod("_reset: url: %s", theUrl, isError=False)
+        self.logMethod("_reset: devAddress %s", resetDevAddress, isError=False)
 
-        except urllib2.URLError, e:
-            self.logMethod("_update: url open error:\n%s" % traceback.format_exc(10))
-        except httplib.BadStatusLine, e:
-            self.logMethod("The Vera isn't responding correctly. Make sure it's available. If it's performing a software upgrade, wait until it's finished then restart the plugin.")
-        except KeyError, e:
-            self.logMethod("_update: key error:\n%s" % traceback.format_exc(10))
-        except Exception, e:
-            self.logMethod("_update: vera update error: %s" % traceback.format_exc(10), isError=True)
-        finally:
-            self.logMethod("_update: ending at %s" % datetime.today().strftime("%H:%M:%S"))
+        def handleResponse(request):
+            try:
+                if request.error is not None:
+                    raise request.error
+            except socket.error, e:
+                self.logMethod("_reset: url open error: %s", e)
+            except httplib.BadStatusLine, e:
+                self.logMethod("The Vera isn't responding correctly. Make sure it's available. If it's performing a software upgrade, wait until it's finished then restart the plugin.")
+            except Exception, e:
+                self.logMethod("_reset: vera reset error: %s", e, isError=True)
+            finally:
+                self.logMethod("_reset: ending at %s", datetime.today().strftime("%H:%M:%S"))
+
+        self._sendCommandRequest(commandDict, theUrl, handleResponse)
 
     ########################################
-    def _executeUrl(self, url, deviceName, command):
-        try:
-            self.logMethod(u"_execute url: %s" % url)
-            f = urllib2.urlopen(url)
-            # infoDict = json.load(f)
-            f.close()
-            self.logMethod(u"sent \"%s\" %s" % (deviceName, command), isDebug=False)
-        except Exception, e:
-            self.logMethod(u"send command error: %s" % traceback.format_exc(10), isError=True)
+    def _executeUrl(self, commandDict, url, deviceName, command):
+        self.logMethod(u"_execute url: %s", url)
+        self._expectCommand(commandDict)
+
+        def handleResponse(request):
+            if request.error is None:
+                jobId = jobIdForActionResponse(request.body)
+                self.logMethod(u"sent \"%s\" %s", deviceName, command, isDebug=False)
+                self.logMethod(u"job id for %s: %s", commandDict, jobId)
+                self._commandAccepted(commandDict, jobId)
+            elif self._retryCommand(commandDict, request):
+                self.logMethod(u"send command error, retrying in %.1f seconds: %s", commandDict["retryAt"] - time.time(), request.error)
+            else:
+                self.logMethod(u"send command error: %s", request.error, isError=True)
+                self._failExpectation(commandDict, str(request.error))
+
+        self._sendCommandRequest(commandDict, url, handleResponse)
+
+    ########################################
+    def _retryCommand(self, commandDict, request):
+        # Puts a command that couldn't be sent back at the front of the line to go again after a backoff. Returns
+        # False if it's out of retries or isn't safe to send again.
+        attempt = commandDict.get("attempt", 0) + 1
+        if attempt > kCommandRetries or not self.shouldContinue:
+            return False
+        if not isinstance(request.error, (socket.error, httplib.HTTPException)):
+            return False
+        if commandDict["command"] in kNonRepeatableCommands and request.sent:
+            return False
+        commandDict["attempt"] = attempt
+        commandDict["retryAt"] = time.time() + kCommandRetryDelay * (2 ** (attempt - 1))
+        self.pendingCommands.insert(0, commandDict)
+        return True
+
+    ########################################
+    def _expectCommand(self, commandDict):
+        expectation = kCommandExpectations.get(commandDict["command"], None)
+        if expectation is None:
+            return
+        key, value = expectation
+        if value is None:
+            value = commandDict["value"]
+        # a newer command for the same field replaces the older one's expectation
+        self.expectations[(commandDict["id"], key)] = {
+            "command": commandDict["command"],
+            "value": value,
+            "jobId": None,
+            "deadline": time.time() + kCommandConfirmTimeout,
+            "queuedAt": commandDict.get("queuedAt", time.time()),
+        }
+
+    ########################################
+    def _commandAccepted(self, commandDict, jobId):
+        # A command that doesn't change anything (turning on a light that's already on) never shows up in an update,
+        # so it's confirmed as soon as the Vera accepts it.
+        expectation = kCommandExpectations.get(commandDict["command"], None)
+        if expectation is not None:
+            deviceId, key = commandDict["id"], expectation[0]
+            expected = self.expectations.get((deviceId, key), None)
+            if expected is not None and expected["command"] == commandDict["command"]:
+                expected["jobId"] = jobId
+                if key in self.devices.get(deviceId, {}):
+                    self._checkExpectations({"id": deviceId, key: self.devices[deviceId][key]})
+
+    ########################################
+    def _failExpectation(self, commandDict, reason):
+        expectation = kCommandExpectations.get(commandDict["command"], None)
+        if expectation is not None:
+            expected = self.expectations.pop((commandDict["id"], expectation[0]), None)
+            if expected is not None:
+                self._queueConfirmation("commandUnconfirmed", commandDict["id"], expectation[0], expected, reason)
+
+    ########################################
+    def _checkExpectations(self, deviceInfo):
+        # a command is confirmed when the state it should have changed shows up with the value it should have
+        deviceId = deviceInfo["id"]
+        for key, value in deviceInfo.iteritems():
+            expected = self.expectations.get((deviceId, key), None)
+            if expected is not None and stateValuesMatch(expected["value"], value):
+                del self.expectations[(deviceId, key)]
+                self._queueConfirmation("commandConfirmed", deviceId, key, expected)
+
+    ########################################
+    def _expireExpectations(self):
+        # Reports commands whose state never showed up as unconfirmed and returns how long until the next one is due
+        # to expire, or None if there aren't any.
+        now = time.time()
+        nextDeadline = None
+        for (deviceId, key), expected in self.expectations.items():
+            if expected["deadline"] <= now:
+                del self.expectations[(deviceId, key)]
+                self._queueConfirmation("commandUnconfirmed", deviceId, key, expected, "the Vera didn't report the change")
+            elif nextDeadline is None or expected["deadline"] < nextDeadline:
+                nextDeadline = expected["deadline"]
+        return None if nextDeadline is None else nextDeadline - now
+
+    ########################################
+    def _queueConfirmation(self, updateType, deviceId, key, expected, reason=None):
+        self.logMethod("%s: device %i %s=%s (job %s)", updateType, deviceId, key, expected["value"], expected["jobId"])
+        self.metrics.count(updateType)
+        if updateType == "commandConfirmed":
+            # from the command being queued to its change showing up in an update
+            self.metrics.record("commandConfirmTime", (time.time() - expected["queuedAt"]) * 1000)
+        updateDict = {"updateType": updateType, "device": deviceId, "command": expected["command"], "key": key, "value": expected["value"], "jobId": expected["jobId"]}
+        if reason:
+            updateDict["reason"] = reason
+        self._queueUpdate(updateDict)
+
+    ########################################
+    def _commandTarget(self, commandDict):
+        if commandDict["command"] == kCommand_RunScene:
+            return ("scene", commandDict["id"])
+        return ("device", commandDict["id"])
+
+    ########################################
+    def _sendCommandRequest(self, commandDict, url, handleResponse):
+        # the command's device (or scene) is busy until the Vera has answered, see _dispatchCommands
+        target = self._commandTarget(commandDict)
+        self.busyTargets.add(target)
+        sentAt = time.time()
+
+        def finished(request):
+            self.busyTargets.discard(target)
+            now = time.time()
+            self.logMethod("%s for %s %i answered in %.3f seconds", commandDict["command"], target[0], target[1], now - sentAt)
+            self.metrics.count("commandsSent")
+            if request.error is not None:
+                self.metrics.count("commandFailures")
+            else:
+                self.metrics.record("commandTime", (now - sentAt) * 1000)
+                # including the time it waited behind other commands and the pacing
+                self.metrics.record("commandLatency", (now - commandDict.get("queuedAt", sentAt)) * 1000)
+            handleResponse(request)
+
+        self.client.request(url, finished, timeouts=kCommandTimeouts, repeatable=commandDict["command"] not in kNonRepeatableCommands)
+
+    ########################################
+    def _addPendingCommand(self, commandDict):
+        # The newest command goes to the back of the line even when it replaces one, so it's still sent after
+        # anything that was queued for the device in between.
+        group = kCoalescedCommands.get(commandDict["command"], None)
+        if group is not None:
+            for pendingDict in self.pendingCommands:
+                if pendingDict["id"] == commandDict["id"] and kCoalescedCommands.get(pendingDict["command"], None) == group:
+                    self.logMethod("dropping command replaced by a newer one: %s", pendingDict)
+                    self.pendingCommands.remove(pendingDict)
+                    break
+        self.pendingCommands.append(commandDict)
+
+    ########################################
+    def _dispatchCommands(self):
+        # Sends as many of the queued commands as the in-flight cap, the pacing and retry backoffs allow. Returns how
+        # long until the next one that's waiting on those can go, or None if there aren't any.
+        while True:
+            try:
+                commandDict = self.commandQueue.get_nowait()
+            except Queue.Empty:
+                break
+            self.commandQueue.task_done()
+            if commandDict is not None:
+                self._addPendingCommand(commandDict)
+        # Until the first full update (or the snapshot) has told us what's on the Vera there's no telling a device
+        # that doesn't exist from one we just haven't heard about yet, so everything waits for the inventory. The
+        # poll that loads it wakes the run loop when it's done.
+        if not self.lastFullUpdate:
+            return None
+        # A command waits until the Vera has answered any earlier one for the same device or scene so they still
+        # happen in the order they were queued, so only the first one waiting for each device or scene can go now.
+        # Of those the highest priority goes first, and otherwise the one that's been waiting longest.
+        readyCommands = []
+        waitingTargets = set()
+        for index, commandDict in enumerate(self.pendingCommands):
+            target = self._commandTarget(commandDict)
+            if target in waitingTargets:
+                continue
+            waitingTargets.add(target)
+            if target not in self.busyTargets:
+                readyCommands.append((kCommandPriorities.get(commandDict["command"], kCommandPriority_Normal), index, commandDict))
+        readyCommands.sort(key=itemgetter(0, 1))
+        nextWait = None
+        for priority, index, commandDict in readyCommands:
+            if len(self.busyTargets) >= self.maxCommandsInFlight:
+                break
+            now = time.time()
+            paced = commandDict["command"] not in kUnpacedCommands
+            sendAt = commandDict.get("retryAt", 0)
+            if paced:
+                sendAt = max(sendAt, self.lastCommandSent + self.commandPacing)
+            if sendAt > now:
+                nextWait = sendAt - now if nextWait is None else min(nextWait, sendAt - now)
+                continue
+            self.pendingCommands.remove(commandDict)
+            if paced:
+                self.lastCommandSent = now
+            try:
+                self.logMethod("processing command after waiting %.3f seconds: %s", now - commandDict.get("queuedAt", now), commandDict)
+                self._processCommand(commandDict)
+            except Exception, e:
+                self.logMethod("command error: %s", traceback.format_exc(10), isError=True)
+        return nextWait
 
     ########################################
     def _processCommand(self, commandDict):
@@ -309,50 +2089,55 @@ class Vera(threading.Thread):
             sceneId = commandDict["id"]
             scene = self.scenes.get(sceneId, None)
             if scene and bool(scene["active"]):
-                theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kRunSceneServiceString % sceneId)
-                self._executeUrl(theUrl, scene["name"], "run scene")
+                theUrl = "%s&%s" % (kActionUrl, kRunSceneServiceString % sceneId)
+                self._executeUrl(commandDict, theUrl, scene["name"], "run scene")
             else:
-                self.logMethod(u"send command error: scene %i does not exist or is inactive" % sceneId, isError=True)
+                self.logMethod(u"send command error: scene %i does not exist or is inactive", sceneId, isError=True)
         else:
             # since it's not a run scene command then it's a device command
             self.logMethod("_processCommand: performing device command")
             deviceId = commandDict["id"]
             if deviceId not in self.devices:
-                self.logMethod(u"send command error: device %i does not exist" % deviceId, isError=True)
-                self.updateQueue.put_nowait({"updateType": "deleteDevice", "device": {"id": deviceId}})
+                # the inventory is loaded by now (see _dispatchCommands) so the device really is gone
+                self.logMethod(u"send command error: device %i does not exist", deviceId, isError=True)
+                self._queueUpdate({"updateType": "deleteDevice", "device": deviceId})
             else:
                 deviceName = self.devices[deviceId]["name"]
 
-                if command == kCommand_TurnOff:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kOnOffServiceString % (deviceId, 0))
-                    self._executeUrl(theUrl, deviceName, "off")
+                if command == kCommand_RefreshDevice:
+                    self._refreshDevice(commandDict)
+                elif command == kCommand_ResetKwh:
+                    self._resetKwh(commandDict)
+                elif command == kCommand_TurnOff:
+                    theUrl = "%s&%s" % (kActionUrl, kOnOffServiceString % (deviceId, 0))
+                    self._executeUrl(commandDict, theUrl, deviceName, "off")
                 elif command == kCommand_TurnOn:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kOnOffServiceString % (deviceId, 1))
-                    self._executeUrl(theUrl, deviceName, "on")
+                    theUrl = "%s&%s" % (kActionUrl, kOnOffServiceString % (deviceId, 1))
+                    self._executeUrl(commandDict, theUrl, deviceName, "on")
                 elif command == kCommand_SetBrightness:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kBrightnessServiceString % (deviceId, commandDict["value"]))
-                    self._executeUrl(theUrl, deviceName, "on to %i" % commandDict["value"])
+                    theUrl = "%s&%s" % (kActionUrl, kBrightnessServiceString % (deviceId, commandDict["value"]))
+                    self._executeUrl(commandDict, theUrl, deviceName, "on to %i" % commandDict["value"])
 
                 elif command == kCommand_SetHeatSetpoint:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kThermostatServiceString_HeatSetpoint % (deviceId, commandDict["value"]))
-                    self.logMethod("_processCommand: url: %s" % theUrl)
-                    self._executeUrl(theUrl, deviceName, "set heat setpoint to %i" % commandDict["value"])
+                    theUrl = "%s&%s" % (kActionUrl, kThermostatServiceString_HeatSetpoint % (deviceId, commandDict["value"]))
+                    self.logMethod("_processCommand: url: %s", theUrl)
+                    self._executeUrl(commandDict, theUrl, deviceName, "set heat setpoint to %i" % commandDict["value"])
                 elif command == kCommand_SetCoolSetpoint:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kThermostatServiceString_CoolSetpoint % (deviceId, commandDict["value"]))
-                    self.logMethod("_processCommand: url: %s" % theUrl)
-                    self._executeUrl(theUrl, deviceName, "set heat setpoint to %i" % commandDict["value"])
+                    theUrl = "%s&%s" % (kActionUrl, kThermostatServiceString_CoolSetpoint % (deviceId, commandDict["value"]))
+                    self.logMethod("_processCommand: url: %s", theUrl)
+                    self._executeUrl(commandDict, theUrl, deviceName, "set heat setpoint to %i" % commandDict["value"])
                 elif command == kCommand_SetThermostatMode:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kThermostatServiceString_Mode % (deviceId, commandDict["value"]))
-                    self.logMethod("_processCommand: url: %s" % theUrl)
-                    self._executeUrl(theUrl, deviceName, "set mode to %s" % commandDict["value"])
+                    theUrl = "%s&%s" % (kActionUrl, kThermostatServiceString_Mode % (deviceId, commandDict["value"]))
+                    self.logMethod("_processCommand: url: %s", theUrl)
+                    self._executeUrl(commandDict, theUrl, deviceName, "set mode to %s" % commandDict["value"])
                 elif command == kCommand_SetThermostatFanMode:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kThermostatServiceString_FanMode % (deviceId, commandDict["value"]))
-                    self.logMethod("_processCommand: url: %s" % theUrl)
-                    self._executeUrl(theUrl, deviceName, "set mode to %s" % commandDict["value"])
+                    theUrl = "%s&%s" % (kActionUrl, kThermostatServiceString_FanMode % (deviceId, commandDict["value"]))
+                    self.logMethod("_processCommand: url: %s", theUrl)
+                    self._executeUrl(commandDict, theUrl, deviceName, "set mode to %s" % commandDict["value"])
 
                 elif command == kCommand_Unlock:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kLockServiceString % (deviceId, 0))
-                    self._executeUrl(theUrl, deviceName, "unlock")
+                    theUrl = "%s&%s" % (kActionUrl, kLockServiceString % (deviceId, 0))
+                    self._executeUrl(commandDict, theUrl, deviceName, "unlock")
                 elif command == kCommand_Lock:
-                    theUrl = "http://%s:%i/%s&%s" % (self.address, self.port, kActionUrl, kLockServiceString % (deviceId, 1))
-                    self._executeUrl(theUrl, deviceName, "lock")
+                    theUrl = "%s&%s" % (kActionUrl, kLockServiceString % (deviceId, 1))
+                    self._executeUrl(commandDict, theUrl, deviceName, "lock")
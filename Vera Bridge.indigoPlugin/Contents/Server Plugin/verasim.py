@@ -0,0 +1,361 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+
+import threading
+import httplib
+import heapq
+import random
+import json
+import socket
+import time
+import urlparse
+from collections import deque
+
+import veralib
+
+################################################################################
+# Globals
+################################################################################
+# the host the plugin shows for a simulated Vera
+kSimulatorHost = u"simulator"
+kSimulatorPort = 3480
+kDefaultDeviceCount = 100
+kDefaultChangeRate = 1.0
+# how long a simulated device takes to report that it did what it was told
+kDefaultCommandDelay = 0.5
+# the categories devices are created with, in proportion - every category in kVeraDeviceTypeMap shows up, with the
+# ones the plugin supports most often like they would be in a real house
+kSimulatedCategoryMix = [2, 2, 2, 2, 2, 3, 3, 3, 27, 5, 5, 7, 7, 4, 6, 8, 12, 16, 17, 18, 21, 24, 25, 28, 29]
+# the fields each category starts with, and which of them change on their own
+kSimulatedFields = {
+    2: {"status": "0", "level": "0", "watts": "0", "kwh": "0.00"},
+    3: {"status": "0", "watts": "0", "kwh": "0.00"},
+    4: {"tripped": "0", "armed": "0", "batterylevel": "100"},
+    5: {"temperature": "70", "heatsp": "68", "coolsp": "76", "mode": "Off", "fanmode": "Auto", "hvacstate": "Idle", "batterylevel": "100"},
+    6: {},
+    7: {"status": "1", "locked": "1", "batterylevel": "100"},
+    8: {"status": "0", "level": "0"},
+    12: {"tripped": "0"},
+    16: {"humidity": "40", "batterylevel": "100"},
+    17: {"temperature": "70", "batterylevel": "100"},
+    18: {"light": "100", "batterylevel": "100"},
+    21: {"watts": "0", "kwh": "0.00"},
+    24: {"status": "0"},
+    25: {"temperature": "60", "humidity": "50"},
+    27: {"status": "0", "watts": "0", "kwh": "0.00"},
+    28: {"light": "0"},
+    29: {"tripped": "0"},
+}
+# Dimmer levels and on/off states only change when a command or scene asks for it, so what the user sees in Indigo
+# is what they did. Everything else here wanders on its own.
+kChurnFields = {
+    2: ["watts", "kwh"],
+    3: ["watts", "kwh"],
+    4: ["tripped", "batterylevel"],
+    5: ["temperature", "hvacstate", "batterylevel"],
+    7: ["batterylevel"],
+    12: ["tripped"],
+    16: ["humidity", "batterylevel"],
+    17: ["temperature", "batterylevel"],
+    18: ["light", "batterylevel"],
+    21: ["watts", "kwh"],
+    25: ["temperature", "humidity"],
+    27: ["watts", "kwh"],
+    28: ["light"],
+    29: ["tripped"],
+}
+kScenesPerDevices = 10
+
+
+################################################################################
+class VeraSimulation(object):
+    # The devices and scenes of a pretend Vera. It answers the same data requests a Vera does (lu_sdata, lu_action
+    # and status, as decoded JSON) and changes devices on its own at changeRate a second. It isn't thread safe - the
+    # simulator client only uses it from the vera thread and fakeVera.py in the benchmarks wraps it in a lock.
+
+    def __init__(self, deviceCount=kDefaultDeviceCount, sceneCount=None, changeRate=kDefaultChangeRate, commandDelay=kDefaultCommandDelay, seed=None):
+        self.rng = random.Random(seed)
+        # a new loadtime each time makes the bridge start over with a full update, like after a Vera restart
+        self.loadTime = int(time.time())
+        self.dataVersion = 1
+        self.changeRate = changeRate
+        self.commandDelay = commandDelay
+        self.devices = {}
+        # the dataversion each device last changed in
+        self.deviceVersions = {}
+        for deviceId in range(1, deviceCount + 1):
+            category = kSimulatedCategoryMix[deviceId % len(kSimulatedCategoryMix)]
+            device = {
+                "id": deviceId,
+                "name": "Simulated %s %i" % (veralib.kVeraDeviceTypeMap[category][1], deviceId),
+                "altid": str(deviceId),
+                "category": category,
+                "subcategory": 0,
+                "room": 1 + deviceId % 10,
+                "parent": 1,
+                "state": -1,
+                "comment": "",
+            }
+            device.update(kSimulatedFields[category])
+            self.devices[deviceId] = device
+            self.deviceVersions[deviceId] = self.dataVersion
+        if sceneCount is None:
+            sceneCount = max(1, deviceCount // kScenesPerDevices)
+        switches = sorted(deviceId for deviceId, device in self.devices.iteritems() if device["category"] in (2, 3, 27))
+        self.scenes = {}
+        # the switches and dimmers each scene turns on
+        self.sceneDevices = {}
+        for sceneId in range(1, sceneCount + 1):
+            self.scenes[sceneId] = {"id": sceneId, "name": "Simulated Scene %i" % sceneId, "room": 1 + sceneId % 10, "active": 1}
+            self.sceneDevices[sceneId] = switches[sceneId % max(len(switches), 1):][:3]
+        # (when, device id, fields) for commands the devices haven't carried out yet
+        self.pendingChanges = []
+        self.nextChange = None
+
+    ########################################
+    def advance(self, now):
+        # Carries out everything that was due by now and returns when something will next change (or None).
+        while self.pendingChanges and self.pendingChanges[0][0] <= now:
+            dueAt, deviceId, fields = heapq.heappop(self.pendingChanges)
+            self._setFields(deviceId, fields)
+        if self.changeRate > 0 and self.devices:
+            if self.nextChange is None:
+                self.nextChange = now + self.rng.expovariate(self.changeRate)
+            while self.nextChange <= now:
+                self._churn()
+                self.nextChange += self.rng.expovariate(self.changeRate)
+        nextTimes = [self.nextChange] if self.nextChange is not None else []
+        if self.pendingChanges:
+            nextTimes.append(self.pendingChanges[0][0])
+        return min(nextTimes) if nextTimes else None
+
+    ########################################
+    def change(self, deviceId):
+        # Makes a device change in a way the plugin shows (a dimmer's level, a lock, an on/off) and returns the fields
+        # that changed along with the device id.
+        device = self.devices[deviceId]
+        if "level" in device:
+            level = self.rng.randint(1, 99)
+            while str(level) == device["level"]:
+                level = self.rng.randint(1, 99)
+            fields = {"level": str(level), "status": "1"}
+        elif "locked" in device:
+            fields = {"locked": "0" if device["locked"] == "1" else "1"}
+        elif "status" in device:
+            fields = {"status": "0" if device["status"] == "1" else "1"}
+        else:
+            fields = self._churnedFields(device)
+        self._setFields(deviceId, fields)
+        return dict(fields, id=deviceId)
+
+    ########################################
+    def sdata(self, query):
+        # returns the lu_sdata answer for the query - everything if its loadtime isn't ours, otherwise the devices
+        # that changed since its dataversion
+        if int(query.get("loadtime", 0)) != self.loadTime:
+            return {
+                "full": 1,
+                "version": "*1.7.0*",
+                "model": "Simulated Vera",
+                "serial_number": "0",
+                "loadtime": self.loadTime,
+                "dataversion": self.dataVersion,
+                "state": -1,
+                "rooms": [{"id": roomId, "name": "Room %i" % roomId, "section": 1} for roomId in range(1, 11)],
+                "scenes": [dict(scene) for scene in self.scenes.itervalues()],
+                "devices": [dict(device) for device in self.devices.itervalues()],
+            }
+        # incremental updates leave the category out, like the Vera does
+        dataVersion = int(query.get("dataversion", 0))
+        devices = [dict((key, value) for key, value in self.devices[deviceId].iteritems() if key != "category")
+                   for deviceId, version in self.deviceVersions.iteritems() if version > dataVersion]
+        return {"full": 0, "loadtime": self.loadTime, "dataversion": self.dataVersion, "state": -1, "devices": devices}
+
+    ########################################
+    def hasChangedSince(self, query):
+        return int(query.get("loadtime", 0)) != self.loadTime or self.dataVersion > int(query.get("dataversion", 0))
+
+    ########################################
+    def action(self, query, now):
+        # Accepts a command and returns the answer the Vera gives, carrying it out commandDelay seconds later.
+        serviceId = query.get("serviceId", "")
+        if serviceId.endswith("HomeAutomationGateway1"):
+            sceneId = int(query.get("SceneNum", 0))
+            if sceneId not in self.scenes:
+                return "ERROR: Invalid Scene"
+            for deviceId in self.sceneDevices[sceneId]:
+                fields = {"status": "1"}
+                if "level" in self.devices[deviceId]:
+                    fields["level"] = "100"
+                self._schedule(now, deviceId, fields)
+            return {"u:RunSceneResponse": {"OK": "OK"}}
+        deviceId = int(query.get("DeviceNum", 0))
+        if deviceId not in self.devices:
+            return "ERROR: Invalid Device"
+        fields = {}
+        if "newLoadlevelTarget" in query:
+            level = int(query["newLoadlevelTarget"])
+            fields = {"level": str(level), "status": "1" if level else "0"}
+        elif "DoorLock1" in serviceId:
+            fields = {"locked": query.get("newTargetValue", "0")}
+        elif "newTargetValue" in query:
+            fields = {"status": query["newTargetValue"]}
+            if "level" in self.devices[deviceId]:
+                fields["level"] = "100" if query["newTargetValue"] == "1" else "0"
+        elif "NewCurrentSetpoint" in query:
+            fields = {"heatsp" if serviceId.endswith("_Heat") else "coolsp": query["NewCurrentSetpoint"]}
+        elif "NewModeTarget" in query:
+            fields = {"mode": query["NewModeTarget"]}
+        elif "NewMode" in query:
+            fields = {"fanmode": query["NewMode"]}
+        elif query.get("action", "") == "ResetKWH":
+            fields = {"kwh": "0.00"}
+        if fields:
+            self._schedule(now, deviceId, fields)
+        return {"u:%sResponse" % query.get("action", "Action"): {"JobID": str(self.dataVersion)}}
+
+    ########################################
+    def status(self, query):
+        # the per device status request answers with upnp state variables rather than lu_sdata fields
+        deviceId = int(query.get("DeviceNum", 0))
+        device = self.devices.get(deviceId, {})
+        states = [{"service": service, "variable": variable, "value": device[key]}
+                  for (service, variable), key in veralib.kStatusVariableMap.iteritems() if key in device]
+        return {"Device_Num_%i" % deviceId: {"states": states}}
+
+    ########################################
+    def _schedule(self, now, deviceId, fields):
+        if self.commandDelay > 0:
+            heapq.heappush(self.pendingChanges, (now + self.commandDelay, deviceId, fields))
+        else:
+            self._setFields(deviceId, fields)
+
+    ########################################
+    def _churn(self):
+        deviceId = self.rng.randint(1, len(self.devices))
+        fields = self._churnedFields(self.devices[deviceId])
+        if fields:
+            self._setFields(deviceId, fields)
+
+    ########################################
+    def _churnedFields(self, device):
+        churnFields = kChurnFields.get(device["category"], None)
+        if not churnFields:
+            return {}
+        key = self.rng.choice(churnFields)
+        if key == "tripped":
+            value = "0" if device[key] == "1" else "1"
+        elif key == "hvacstate":
+            value = self.rng.choice(["Idle", "Heating", "Cooling"])
+        elif key == "kwh":
+            value = "%.2f" % (float(device[key]) + self.rng.uniform(0, 0.1))
+        elif key == "watts":
+            value = "%.1f" % self.rng.uniform(0, 1500)
+        elif key == "batterylevel":
+            value = str(max(0, int(device[key]) - self.rng.randint(0, 1)))
+        else:
+            value = str(max(0, int(device[key]) + self.rng.randint(-2, 2)))
+        return {key: value}
+
+    ########################################
+    def _setFields(self, deviceId, fields):
+        self.dataVersion += 1
+        self.devices[deviceId].update(fields)
+        self.deviceVersions[deviceId] = self.dataVersion
+
+
+################################################################################
+class VeraSimulatorClient(object):
+    # Stands in for VeraClient and answers a Vera's requests from a VeraSimulation, on the vera thread, without any
+    # network. Long polls are held until the simulation changes (and then for the minimumdelay they ask for) the way
+    # a Vera holds them, and the answers go through the same parsing as ones from the network.
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.waitingRequests = deque()
+        self.closed = False
+        self.recorder = None
+        self.wakeEvent = threading.Event()
+
+    ########################################
+    def wake(self):
+        self.wakeEvent.set()
+
+    ########################################
+    def request(self, path, callback, timeouts=veralib.kPollTimeouts, consumer=None, interruptible=False, repeatable=True):
+        if self.closed:
+            raise socket.error("the simulator is closed")
+        request = veralib.VeraRequest(path, callback, timeouts, consumer, interruptible, repeatable)
+        request.startedAt = time.time()
+        self.waitingRequests.append(request)
+        return request
+
+    ########################################
+    def interrupt(self):
+        for request in list(self.waitingRequests):
+            if request.interruptible:
+                self.waitingRequests.remove(request)
+                request.complete(veralib.RequestInterrupted("request interrupted: %s" % request.path))
+
+    ########################################
+    def runOnce(self, timeout):
+        now = time.time()
+        nextChange = self.simulation.advance(now)
+        if nextChange is not None:
+            timeout = min(timeout, nextChange - now)
+        answered = False
+        for request in list(self.waitingRequests):
+            query = dict(urlparse.parse_qsl(urlparse.urlparse(request.path).query))
+            requestId = query.get("id", "")
+            if requestId == "lu_sdata":
+                longPollTimeout = int(query.get("timeout", 0))
+                if self.simulation.hasChangedSince(query):
+                    answerAt = request.startedAt + int(query.get("minimumdelay", 0)) / 1000.0
+                else:
+                    answerAt = request.startedAt + longPollTimeout
+                if answerAt > now:
+                    timeout = min(timeout, answerAt - now)
+                    continue
+                body = self.simulation.sdata(query)
+            elif requestId in ("lu_action", "action"):
+                body = self.simulation.action(query, now)
+            elif requestId == "status":
+                body = self.simulation.status(query)
+            else:
+                body = None
+            self.waitingRequests.remove(request)
+            self._answer(request, body)
+            answered = True
+        if answered:
+            # the Vera will want to look at the answers
+            return
+        self.wakeEvent.wait(max(timeout, 0))
+        self.wakeEvent.clear()
+
+    ########################################
+    def close(self):
+        self.closed = True
+        self.waitingRequests.clear()
+
+    ########################################
+    def _answer(self, request, body):
+        if body is None:
+            request.status = 404
+            request.complete(httplib.HTTPException("HTTP error 404: Not Found"))
+            return
+        request.status = httplib.OK
+        data = body if isinstance(body, basestring) else json.dumps(body)
+        for offset in range(0, len(data), veralib.kReadChunkSize):
+            request.handleData(data[offset:offset + veralib.kReadChunkSize])
+        request.complete(None)
+
+
+################################################################################
+class SimulatedVera(veralib.Vera):
+    # A Vera thread talking to a simulation instead of a real Vera. Everything else - polling, commands and their
+    # confirmation, the inventory - is the same code a real Vera gets.
+
+    def __init__(self, deviceCount=kDefaultDeviceCount, changeRate=kDefaultChangeRate, commandDelay=kDefaultCommandDelay, seed=None, **kwargs):
+        self.simulation = VeraSimulation(deviceCount, changeRate=changeRate, commandDelay=commandDelay, seed=seed)
+        veralib.Vera.__init__(self, kSimulatorHost, kSimulatorPort, client=VeraSimulatorClient(self.simulation), **kwargs)
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# A stand-in for a Vera that serves enough of the HTTP API for veralib to talk to it: lu_sdata (full, incremental
+# and long poll, keyed on loadtime/dataversion), lu_action, status and the energy meter reset. It can be given any
+# number of devices and scenes and changes some of them every second so there's always something to poll for. The
+# devices themselves are the plugin's own simulation (verasim.py), served over HTTP so veralib's networking is part
+# of what gets measured.
+#
+# Two requests that a real Vera doesn't have are there for the benchmarks:
+#   /data_request?id=bench_change&DeviceNum=N  changes the device right away and answers with what changed
+#   /data_request?id=bench_stats               answers with how many requests of each kind have been served
+#
+# Run it on its own with: python fakeVera.py --port 3480 --devices 1000
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Vera Bridge.indigoPlugin", "Contents", "Server Plugin"))
+
+import verasim
+
+
+################################################################################
+class FakeVera(object):
+    ########################################
+    def __init__(self, deviceCount=100, sceneCount=10, changeRate=1.0, commandDelay=0, seed=None):
+        self.simulation = verasim.VeraSimulation(deviceCount, sceneCount, changeRate, commandDelay, seed)
+        self.lock = threading.Condition()
+        self.stats = {"sdataFull": 0, "sdataIncremental": 0, "action": 0, "status": 0, "bytes": 0, "changes": 0}
+        self.server = None
+        self.shouldContinue = True
+
+    ########################################
+    def serve(self, port, address="127.0.0.1"):
+        # blocks until stop() is called
+        fakeVera = self
+
+        class Handler(FakeVeraHandler):
+            vera = fakeVera
+
+        self.server = FakeVeraServer((address, port), Handler)
+        changer = threading.Thread(target=self._advance)
+        changer.daemon = True
+        changer.start()
+        self.server.serve_forever()
+
+    ########################################
+    def stop(self):
+        self.shouldContinue = False
+        with self.lock:
+            self.lock.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+
+    ########################################
+    def changeDevice(self, deviceId=None):
+        # Changes a device in a way the plugin shows (a dimmer's level, a lock...) and returns the fields that changed.
+        with self.lock:
+            if deviceId is None:
+                deviceId = self.simulation.rng.choice(self.simulation.devices.keys())
+            changes = self.simulation.change(deviceId)
+            self.stats["changes"] += 1
+            self.lock.notify_all()
+            return changes
+
+    ########################################
+    def _advance(self):
+        # background changes and delayed commands - dimmer levels are left alone, so the benchmarks can recognize
+        # the changes they asked for
+        with self.lock:
+            while self.shouldContinue:
+                dataVersion = self.simulation.dataVersion
+                nextChange = self.simulation.advance(time.time())
+                if self.simulation.dataVersion != dataVersion:
+                    self.lock.notify_all()
+                self.lock.wait(max(nextChange - time.time(), 0.001) if nextChange is not None else None)
+
+    ########################################
+    def sdata(self, query):
+        with self.lock:
+            if int(query.get("loadtime", 0)) != self.simulation.loadTime:
+                self.stats["sdataFull"] += 1
+                return self.simulation.sdata(query)
+        # like the Vera, hold the request until something changes or the timeout runs out and then wait out the
+        # rest of minimumdelay so changes close together go in the same answer
+        startTime = time.time()
+        deadline = startTime + int(query.get("timeout", 0))
+        with self.lock:
+            while not self.simulation.hasChangedSince(query) and self.shouldContinue and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            changed = self.simulation.hasChangedSince(query)
+        minimumDelay = int(query.get("minimumdelay", 0)) / 1000.0
+        if changed and time.time() - startTime < minimumDelay:
+            time.sleep(minimumDelay - (time.time() - startTime))
+        with self.lock:
+            self.stats["sdataIncremental"] += 1
+            return self.simulation.sdata(query)
+
+    ########################################
+    def action(self, query):
+        with self.lock:
+            self.stats["action"] += 1
+            answer = self.simulation.action(query, time.time())
+            # the changer carries out commands with a delay, without one they're done already
+            self.lock.notify_all()
+            return answer
+
+    ########################################
+    def status(self, query):
+        with self.lock:
+            self.stats["status"] += 1
+            return self.simulation.status(query)
+
+
+################################################################################
+class FakeVeraServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+################################################################################
+class FakeVeraHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # veralib keeps its connections open between requests
+    protocol_version = "HTTP/1.1"
+    vera = None
+
+    ########################################
+    def log_message(self, format, *args):
+        pass
+
+    ########################################
+    def do_GET(self):
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        requestId = query.get("id", "")
+        if requestId == "lu_sdata":
+            body = self.vera.sdata(query)
+        elif requestId in ("lu_action", "action"):
+            body = self.vera.action(query)
+        elif requestId == "status":
+            body = self.vera.status(query)
+        elif requestId == "bench_change":
+            body = self.vera.changeDevice(int(query["DeviceNum"]) if "DeviceNum" in query else None)
+        elif requestId == "bench_stats":
+            with self.vera.lock:
+                body = dict(self.vera.stats, dataversion=self.vera.simulation.dataVersion)
+        else:
+            self.send_error(404)
+            return
+        data = body if isinstance(body, basestring) else json.dumps(body)
+        with self.vera.lock:
+            self.vera.stats["bytes"] += len(data)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json" if not isinstance(body, basestring) else "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Serves a fake Vera for veralib to talk to.")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3480)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--scenes", type=int, default=10)
+    parser.add_argument("--change-rate", type=float, default=1.0, help="background device changes a second")
+    parser.add_argument("--command-delay", type=float, default=0, help="seconds devices take to carry out commands")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    fakeVera = FakeVera(args.devices, args.scenes, args.change_rate, args.command_delay, args.seed)
+    try:
+        fakeVera.serve(args.port, args.address)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Just enough of the indigo module for plugin.py to be imported and have its update processing driven outside of
+# the Indigo server. Devices keep their states in memory and count how often they're written, nothing else happens.
+
+import logging
+import sys
+import tempfile
+import time
+
+
+################################################################################
+class _Constants(object):
+    # the enumerations plugin.py compares against - each value is just a distinct string
+    def __init__(self, name, *values):
+        for value in values:
+            setattr(self, value, "%s.%s" % (name, value))
+
+
+kHvacMode = _Constants("kHvacMode", "Off", "Heat", "Cool", "HeatCool", "ProgramHeat", "ProgramCool", "ProgramHeatCool")
+kFanMode = _Constants("kFanMode", "Auto", "AlwaysOn")
+kProtocol = _Constants("kProtocol", "Plugin")
+kDeviceAction = _Constants("kDeviceAction", "TurnOn", "TurnOff", "Toggle", "SetBrightness", "BrightenBy", "DimBy")
+kDeviceGeneralAction = _Constants("kDeviceGeneralAction", "RequestStatus")
+kThermostatAction = _Constants("kThermostatAction", "SetHvacMode", "SetFanMode", "SetHeatSetpoint", "SetCoolSetpoint",
+                               "IncreaseHeatSetpoint", "DecreaseHeatSetpoint", "IncreaseCoolSetpoint", "DecreaseCoolSetpoint")
+kUniversalAction = _Constants("kUniversalAction", "Beep", "EnergyUpdate", "EnergyReset", "RequestStatus")
+
+
+################################################################################
+class Dict(dict):
+    pass
+
+
+################################################################################
+class Device(object):
+    ########################################
+    def __init__(self, id, name, address, deviceTypeId, pluginProps=None):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.deviceTypeId = deviceTypeId
+        self.pluginProps = Dict(pluginProps or {})
+        self.enabled = True
+        self.configured = True
+        self.model = ""
+        self.states = Dict()
+        self.errorState = ""
+        # how many times states were written, which is what costs a round trip to the server in Indigo
+        self.stateWrites = 0
+
+    ########################################
+    @property
+    def onState(self):
+        return self.states.get("onOffState", False)
+
+    ########################################
+    @property
+    def brightness(self):
+        return self.states.get("brightnessLevel", 0)
+
+    ########################################
+    @property
+    def heatSetpoint(self):
+        return self.states.get("setpointHeat", 0)
+
+    ########################################
+    @property
+    def coolSetpoint(self):
+        return self.states.get("setpointCool", 0)
+
+    ########################################
+    def updateStatesOnServer(self, keyValueList):
+        self.stateWrites += 1
+        for keyValue in keyValueList:
+            self.states[keyValue["key"]] = keyValue["value"]
+
+    ########################################
+    def setErrorStateOnServer(self, errorState):
+        self.errorState = errorState or ""
+
+    ########################################
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    ########################################
+    def replaceOnServer(self):
+        pass
+
+    ########################################
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = Dict(props)
+
+
+################################################################################
+class _DeviceList(dict):
+    # keyed by device id, but like indigo.devices "in" also works with device names
+    ########################################
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        return any(device.name == key for device in self.itervalues())
+
+    ########################################
+    def iter(self, filter=""):
+        return iter(self.values())
+
+
+################################################################################
+class _DeviceCommands(object):
+    ########################################
+    def __init__(self):
+        self.nextId = 1000
+
+    ########################################
+    def create(self, protocol=None, address="", deviceTypeId="", props=None, name=""):
+        self.nextId += 1
+        device = Device(self.nextId, name, address, deviceTypeId, props)
+        devices[device.id] = device
+        return device
+
+    ########################################
+    def enable(self, device, value=True):
+        device.enabled = value
+
+    ########################################
+    def changeDeviceTypeId(self, device, deviceTypeId):
+        device.deviceTypeId = deviceTypeId
+
+
+################################################################################
+class _Server(object):
+    ########################################
+    def __init__(self):
+        self.installFolder = None
+
+    ########################################
+    def log(self, message, type=None, isError=False):
+        # only errors are worth seeing while benchmarking
+        if isError:
+            print >> sys.stderr, "%s: %s" % (type or "Error", message)
+
+    ########################################
+    def getInstallFolderPath(self):
+        if self.installFolder is None:
+            self.installFolder = tempfile.mkdtemp(prefix="indigo-stub-")
+        return self.installFolder
+
+
+devices = _DeviceList()
+device = _DeviceCommands()
+server = _Server()
+
+
+################################################################################
+class PluginBase(object):
+    ########################################
+    class StopThread(Exception):
+        pass
+
+    ########################################
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.debug = False
+        self.stopThread = False
+        self.logger = logging.getLogger("Plugin")
+
+    ########################################
+    def debugLog(self, message):
+        if self.debug:
+            server.log(message, type=self.pluginDisplayName + " Debug")
+
+    ########################################
+    def errorLog(self, message):
+        server.log(message, type=self.pluginDisplayName + " Error", isError=True)
+
+    ########################################
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread
+        time.sleep(seconds)
@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Plays a traffic log recorded by the plugin ("Record Vera traffic" in its config) back through a vera thread and the
+# plugin's processUpdate(), with the indigo stub standing in for Indigo. By default the log is played as fast as the
+# bridge can take it, which makes it easy to compare two builds on exactly the same workload; --real-time keeps the
+# recorded pace instead. --profile runs both threads under cProfile.
+#
+# Only lu_sdata answers are fed back - commands in the log were sent because of things that happened in Indigo at
+# the time and don't get sent again.
+#
+# usage: python replayTraffic.py LOG [--real-time] [--profile] [--profile-output FILE]
+
+import Queue
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+
+kBenchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+kPluginFolder = os.path.join(kBenchmarkFolder, os.pardir, "Vera Bridge.indigoPlugin", "Contents", "Server Plugin")
+# the indigo stub has to come before anything else called indigo
+sys.path.insert(0, kPluginFolder)
+sys.path.insert(0, kBenchmarkFolder)
+
+import indigo
+import veralib
+import plugin
+
+kPluginId = "com.perceptiveautomation.indigoplugin.vera"
+
+
+################################################################################
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+########################################
+def createDevices(thePlugin, entries):
+    # a stub Indigo device for every supported device in the first full update, like the user would have
+    for entry in entries:
+        if entry.get("type", None) != "request" or "id=lu_sdata" not in entry["path"] or entry["error"] is not None:
+            continue
+        try:
+            sdata = json.loads(entry["body"])
+        except ValueError:
+            continue
+        if not sdata.get("full", 0):
+            continue
+        for deviceInfo in sdata.get("devices", []):
+            if deviceInfo.get("category", None) in veralib.kSupportedDeviceTypes:
+                dev = indigo.device.create(indigo.kProtocol.Plugin, str(deviceInfo["id"]), veralib.modelForDeviceInfo(deviceInfo)[0], {}, deviceInfo.get("name", ""))
+                thePlugin.deviceStartComm(dev)
+        return
+
+
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="Replays a Vera traffic log through the bridge.")
+    parser.add_argument("log")
+    parser.add_argument("--real-time", action="store_true", help="keep the pace the traffic was recorded at")
+    parser.add_argument("--profile", action="store_true", help="profile the vera thread and update processing")
+    parser.add_argument("--profile-output", help="save the profile here instead of printing the top of it")
+    args = parser.parse_args()
+
+    entries = veralib.readTrafficLog(args.log)
+    if not entries or entries[0].get("type", None) != "header":
+        parser.error("%s isn't a traffic log" % args.log)
+    header = entries[0]
+    requests = [entry for entry in entries if entry.get("type", None) == "request"]
+    polls = [entry for entry in requests if "id=lu_sdata" in entry["path"]]
+    recordedSeconds = max(entry["start"] + entry["duration"] for entry in requests) if requests else 0
+    print >> sys.stderr, "replaying %i lu_sdata answers (%i bytes) covering %.1f seconds recorded from %s:%i" % (
+        len(polls), sum(len(entry["body"]) for entry in polls), recordedSeconds, header["address"], header["port"])
+
+    if not args.real_time:
+        # Answers come back instantly, which would look like firmware that doesn't support long polls, and recorded
+        # failures shouldn't hold things up with the usual backoff.
+        veralib.kLongPollFailureLimit = sys.maxint
+        veralib.kRetryInterval = 0
+
+    thePlugin = plugin.Plugin(kPluginId, "Vera Bridge", "replay", indigo.Dict({"host": header["address"], "port": str(header["port"])}))
+    createDevices(thePlugin, entries)
+    client = veralib.VeraReplayClient(entries, realTime=args.real_time)
+    vera = veralib.Vera(header["address"], header["port"], indigo.server.log, thePlugin.debugLog, updateQueue=thePlugin.updateQueue, controllerId=plugin.kPrimaryController, client=client)
+
+    profilers = []
+    if args.profile:
+        veraProfiler = cProfile.Profile()
+        updateProfiler = cProfile.Profile()
+        profilers = [veraProfiler, updateProfiler]
+        veraRun = vera.run
+        vera.run = lambda: veraProfiler.runcall(veraRun)
+
+    processed = 0
+    processingTime = 0.0
+    startTime, startCpu = time.time(), cpuTime()
+    finishTime = startTime
+    vera.start()
+    while True:
+        try:
+            updateDict = thePlugin.updateQueue.get(True, 0.1)
+        except Queue.Empty:
+            if client.finished:
+                break
+            continue
+        updateStart = time.time()
+        if args.profile:
+            updateProfiler.runcall(thePlugin.processUpdate, updateDict)
+        else:
+            thePlugin.processUpdate(updateDict)
+        finishTime = time.time()
+        processingTime += finishTime - updateStart
+        processed += 1
+    vera.stop()
+    vera.join()
+    elapsed = finishTime - startTime
+
+    print "replayed in %.2f seconds (%.1fx the recorded pace), %.2f CPU seconds" % (elapsed, recordedSeconds / elapsed if elapsed else 0, cpuTime() - startCpu)
+    print "%i updates processed, %.0f us each in processUpdate" % (processed, processingTime / processed * 1000000 if processed else 0)
+    print "%i state writes to %i devices, inventory version %i uses about %i bytes" % (
+        sum(dev.stateWrites for dev in indigo.devices.itervalues()), len(indigo.devices), vera.inventory.version, vera.inventory.memoryUsage())
+    if profilers:
+        stats = pstats.Stats(*profilers)
+        if args.profile_output:
+            stats.dump_stats(args.profile_output)
+        else:
+            stats.sort_stats("cumulative").print_stats(30)
+
+
+if __name__ == "__main__":
+    main()
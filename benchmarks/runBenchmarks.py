@@ -0,0 +1,322 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Measures the bridge against fakeVera.py for growing numbers of devices, without Indigo or a real Vera. For each
+# size it starts a fake Vera in its own process, sets the plugin up with a stub device for every supported Vera
+# device (see indigo.py) and lets a vera thread feed the plugin's processUpdate() like runConcurrentThread does.
+# It reports:
+#   - the cost of the first full update and of the incremental polls that follow it
+#   - how long a change on the Vera takes to reach the Indigo device's states
+#   - how long a command takes from being queued to being confirmed by the Vera
+#   - how much memory the device inventory takes up
+#
+# usage: python runBenchmarks.py [--sizes 10,100,1000,2000] [--change-rate 5] [--duration 10] [--samples 20] [--json]
+
+import Queue
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+kBenchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+kPluginFolder = os.path.join(kBenchmarkFolder, os.pardir, "Vera Bridge.indigoPlugin", "Contents", "Server Plugin")
+# the indigo stub has to come before anything else called indigo
+sys.path.insert(0, kPluginFolder)
+sys.path.insert(0, kBenchmarkFolder)
+
+import indigo
+import veralib
+import plugin
+
+kPluginId = "com.perceptiveautomation.indigoplugin.vera"
+kServerStartTimeout = 10
+# how long to wait for anything the vera thread is asked to do before counting it as lost
+kWaitTimeout = 30
+
+
+################################################################################
+def freePort():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+########################################
+def cpuTime():
+    # user + system time of this process - the fake Vera runs in its own so it isn't included
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+########################################
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+########################################
+def fetch(url):
+    return urllib2.urlopen(url, timeout=kWaitTimeout).read()
+
+
+########################################
+def waitFor(condition, timeout=kWaitTimeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for the vera thread")
+        time.sleep(0.005)
+
+
+################################################################################
+class UpdateWatcher(object):
+    # Hands every update from the vera thread to the plugin the way runConcurrentThread does, and notes when ones the
+    # benchmark is waiting for have been processed.
+    ########################################
+    def __init__(self, thePlugin):
+        self.plugin = thePlugin
+        self.condition = threading.Condition()
+        # match function and the time a matching update was processed, keyed by whatever expect() returned
+        self.expected = {}
+        self.processed = 0
+        self.processingTime = 0.0
+        self.shouldContinue = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    ########################################
+    def start(self):
+        self.thread.start()
+
+    ########################################
+    def stop(self):
+        self.shouldContinue = False
+        self.thread.join()
+
+    ########################################
+    def run(self):
+        while self.shouldContinue:
+            try:
+                updateDict = self.plugin.updateQueue.get(True, 0.1)
+            except Queue.Empty:
+                continue
+            startTime = time.time()
+            self.plugin.processUpdate(updateDict)
+            finishTime = time.time()
+            with self.condition:
+                self.processed += 1
+                self.processingTime += finishTime - startTime
+                for key, (match, processedAt) in self.expected.items():
+                    if processedAt is None and match(updateDict):
+                        self.expected[key] = (match, finishTime)
+                self.condition.notify_all()
+            self.plugin.updateQueue.task_done()
+
+    ########################################
+    def expect(self, match):
+        key = object()
+        with self.condition:
+            self.expected[key] = (match, None)
+        return key
+
+    ########################################
+    def wait(self, key, timeout=kWaitTimeout):
+        # returns when the expected update was processed, or None if it never was
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.expected[key][1] is None and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return self.expected.pop(key)[1]
+
+
+################################################################################
+def deviceUpdateMatcher(deviceId, key):
+    return lambda updateDict: updateDict["updateType"] == "updateDevice" and updateDict["device"].get("id", None) == deviceId and key in updateDict["device"]
+
+
+########################################
+def confirmationMatcher(deviceId):
+    return lambda updateDict: updateDict["updateType"] in ("commandConfirmed", "commandUnconfirmed") and updateDict.get("device", None) == deviceId
+
+
+########################################
+def benchmarkSize(deviceCount, args):
+    port = freePort()
+    server = subprocess.Popen([sys.executable, os.path.join(kBenchmarkFolder, "fakeVera.py"), "--port", str(port),
+                               "--devices", str(deviceCount), "--scenes", str(max(1, deviceCount // 20)),
+                               "--change-rate", str(args.change_rate), "--seed", str(args.seed)])
+    try:
+        deadline = time.time() + kServerStartTimeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+        return _benchmarkVera(deviceCount, port, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+########################################
+def _benchmarkVera(deviceCount, port, args):
+    rng = random.Random(args.seed)
+    baseUrl = "http://127.0.0.1:%i" % port
+    results = {"devices": deviceCount}
+
+    # set the plugin up with a device for everything it supports on the Vera
+    sdata = json.loads(fetch(baseUrl + veralib.kPollingUrl))
+    indigo.devices.clear()
+    thePlugin = plugin.Plugin(kPluginId, "Vera Bridge", "benchmark", indigo.Dict({"host": "127.0.0.1", "port": str(port)}))
+    dimmers = []
+    for deviceInfo in sdata["devices"]:
+        if deviceInfo["category"] in veralib.kSupportedDeviceTypes:
+            dev = indigo.device.create(indigo.kProtocol.Plugin, str(deviceInfo["id"]), veralib.modelForDeviceInfo(deviceInfo)[0], {}, deviceInfo["name"])
+            thePlugin.deviceStartComm(dev)
+            if deviceInfo["category"] == 2:
+                dimmers.append(deviceInfo["id"])
+    rng.shuffle(dimmers)
+    results["indigoDevices"] = len(indigo.devices)
+
+    watcher = UpdateWatcher(thePlugin)
+    watcher.start()
+    vera = thePlugin._createVera(plugin.kPrimaryController, "127.0.0.1", port, thePlugin.pluginPrefs)
+    try:
+        # the first full update, until the inventory is published and until the plugin has processed all of it
+        stats = json.loads(fetch(baseUrl + "/data_request?id=bench_stats"))
+        startTime, startCpu = time.time(), cpuTime()
+        vera.start()
+        waitFor(lambda: vera.inventory.version > 0)
+        results["fullUpdateSeconds"] = time.time() - startTime
+        thePlugin.updateQueue.join()
+        results["fullUpdateDeliveredSeconds"] = time.time() - startTime
+        results["fullUpdateCpuSeconds"] = cpuTime() - startCpu
+        results["fullUpdateBytes"] = json.loads(fetch(baseUrl + "/data_request?id=bench_stats"))["bytes"] - stats["bytes"]
+
+        # incremental polls with only the background changes going on
+        stats = json.loads(fetch(baseUrl + "/data_request?id=bench_stats"))
+        startTime, startCpu, startProcessed = time.time(), cpuTime(), watcher.processed
+        time.sleep(args.duration)
+        newStats = json.loads(fetch(baseUrl + "/data_request?id=bench_stats"))
+        elapsed = time.time() - startTime
+        polls = newStats["sdataIncremental"] - stats["sdataIncremental"]
+        results["incrementalPolls"] = polls
+        results["incrementalPollCpuSeconds"] = (cpuTime() - startCpu) / polls if polls else None
+        results["updatesPerSecond"] = (watcher.processed - startProcessed) / elapsed
+
+        # change-to-update latency: dimmer levels only change when we ask, so the next level update for the dimmer
+        # is the one we caused
+        latencies = []
+        pending = []
+        for index in range(args.samples):
+            deviceId = dimmers[index % len(dimmers)]
+            key = watcher.expect(deviceUpdateMatcher(deviceId, "level"))
+            changedAt = time.time()
+            fetch(baseUrl + "/data_request?id=bench_change&DeviceNum=%i" % deviceId)
+            pending.append((key, changedAt))
+            time.sleep(rng.uniform(0, 2 * args.spacing))
+        for key, changedAt in pending:
+            processedAt = watcher.wait(key)
+            if processedAt is not None:
+                latencies.append(processedAt - changedAt)
+        results["changeLatencies"] = latencies
+        results["changesLost"] = args.samples - len(latencies)
+
+        # command round trip: queued to the vera thread until the Vera has confirmed it
+        roundTrips = []
+        pending = []
+        for index in range(args.samples):
+            deviceId = dimmers[index % len(dimmers)]
+            level = rng.randint(1, 99)
+            while str(level) == vera.devices[deviceId].get("level", None):
+                level = rng.randint(1, 99)
+            key = watcher.expect(confirmationMatcher(deviceId))
+            queuedAt = time.time()
+            vera.commandQueue.put_nowait({"id": deviceId, "command": veralib.kCommand_SetBrightness, "value": level})
+            pending.append((key, queuedAt))
+            time.sleep(rng.uniform(0, 2 * args.spacing))
+        for key, queuedAt in pending:
+            processedAt = watcher.wait(key)
+            if processedAt is not None:
+                roundTrips.append(processedAt - queuedAt)
+        results["commandRoundTrips"] = roundTrips
+        results["commandsLost"] = args.samples - len(roundTrips)
+
+        results["inventoryBytes"] = vera.inventory.memoryUsage()
+        results["processUpdateSeconds"] = watcher.processingTime / watcher.processed if watcher.processed else None
+        results["stateWrites"] = sum(dev.stateWrites for dev in indigo.devices.itervalues())
+    finally:
+        vera.stop()
+        vera.join(kWaitTimeout)
+        watcher.stop()
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["maxRssBytes"] = maxRss if sys.platform == "darwin" else maxRss * 1024
+    return results
+
+
+########################################
+def printResults(allResults):
+    def milliseconds(value):
+        return "-" if value is None else "%.1f" % (value * 1000)
+
+    columns = [
+        ("devices", lambda r: "%i" % r["devices"]),
+        ("full KB", lambda r: "%.0f" % (r["fullUpdateBytes"] / 1024.0)),
+        ("full ms", lambda r: milliseconds(r["fullUpdateSeconds"])),
+        ("delivered ms", lambda r: milliseconds(r["fullUpdateDeliveredSeconds"])),
+        ("full cpu ms", lambda r: milliseconds(r["fullUpdateCpuSeconds"])),
+        ("polls", lambda r: "%i" % r["incrementalPolls"]),
+        ("poll cpu ms", lambda r: milliseconds(r["incrementalPollCpuSeconds"])),
+        ("change p50/p95 ms", lambda r: "%s/%s" % (milliseconds(percentile(r["changeLatencies"], 0.5)), milliseconds(percentile(r["changeLatencies"], 0.95)))),
+        ("command p50/p95 ms", lambda r: "%s/%s" % (milliseconds(percentile(r["commandRoundTrips"], 0.5)), milliseconds(percentile(r["commandRoundTrips"], 0.95)))),
+        ("lost", lambda r: "%i" % (r["changesLost"] + r["commandsLost"])),
+        ("inventory KB", lambda r: "%.0f" % (r["inventoryBytes"] / 1024.0)),
+        ("bytes/device", lambda r: "%.0f" % (float(r["inventoryBytes"]) / r["devices"])),
+        ("update us", lambda r: "-" if r["processUpdateSeconds"] is None else "%.0f" % (r["processUpdateSeconds"] * 1000000)),
+        ("max rss MB", lambda r: "%.1f" % (r["maxRssBytes"] / 1048576.0)),
+    ]
+    rows = [[title for title, format in columns]] + [[format(results) for title, format in columns] for results in allResults]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    for row in rows:
+        print "  ".join(value.rjust(width) for value, width in zip(row, widths))
+
+
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Vera Bridge against a fake Vera.")
+    parser.add_argument("--sizes", default="10,100,1000,2000", help="comma separated device counts")
+    parser.add_argument("--change-rate", type=float, default=5.0, help="background device changes a second on the fake Vera")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to measure incremental polling for")
+    parser.add_argument("--samples", type=int, default=20, help="changes and commands to time for each size")
+    parser.add_argument("--spacing", type=float, default=0.25, help="average seconds between timed changes and commands")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    args = parser.parse_args()
+
+    allResults = []
+    for size in args.sizes.split(","):
+        print >> sys.stderr, "benchmarking %s devices..." % size
+        allResults.append(benchmarkSize(int(size), args))
+    if args.json:
+        print json.dumps(allResults, indent=2)
+    else:
+        printResults(allResults)
+
+
+if __name__ == "__main__":
+    main()